@@ -0,0 +1,2 @@
+-- The users tables live in their own database, like users.sqlite3 does next to database.sqlite3
+CREATE DATABASE feint_users OWNER feint;
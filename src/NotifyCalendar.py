@@ -1,39 +1,219 @@
 import datetime
+import itertools
 import os.path
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Optional
 
+import httplib2
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+from dotenv import load_dotenv
+
+load_dotenv(dotenv_path="../.env")
+# Refresh the access token this many seconds before it expires
+CALENDAR_REFRESH_MARGIN = float(os.getenv("CALENDAR_REFRESH_MARGIN", "300"))
+# Where events go: "google", "recorder" (kept in memory) or "http" (fake_calendar.py)
+CALENDAR_SINK = os.getenv("CALENDAR_SINK", "google")
+# Base URL of the Calendar stand-in used by the "http" sink
+CALENDAR_FAKE_URL = os.getenv("CALENDAR_FAKE_URL", "http://127.0.0.1:8089/calendar/v3/")
+# How many events the "recorder" sink keeps
+CALENDAR_RECORDER_SIZE = int(os.getenv("CALENDAR_RECORDER_SIZE", "10000"))
+
 # If modifying these scopes, delete the file token.json.
 SCOPES = ["https://www.googleapis.com/auth/calendar"]
+TOKEN_FILE = "token.json"
+CREDENTIALS_FILE = "credentials.json"
 
 
-def notify(todo_list: list[str]):
-    """Shows basic usage of the Google Calendar API.
-    Prints the start and name of the next 10 events on the user's calendar.
-    """
-    creds = None
-    # The file token.json stores the user's access and refresh tokens, and is
-    # created automatically when the authorization flow completes for the first
-    # time.
-    if os.path.exists("token.json"):
-        creds = Credentials.from_authorized_user_file("token.json", SCOPES)
-    # If there are no (valid) credentials available, let the user log in.
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file("credentials.json", SCOPES)
-            creds = flow.run_local_server(port=0)
-        # Save the credentials for the next run
-        with open("token.json", "w") as token:
-            token.write(creds.to_json())
+# Destination for the events notify() creates, picked with CALENDAR_SINK so the notify
+# path can be load tested without touching Google
+class CalendarSink(ABC):
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    @abstractmethod
+    def insert_event(self, event: dict) -> dict: ...
+
+
+# Process-wide owner of the Calendar credentials and service object. The service is
+# built once from the discovery document bundled with googleapiclient, and a
+# background thread refreshes the token ahead of expiry, so a notification only
+# costs the insert request itself.
+class GoogleSink(CalendarSink):
+    def __init__(self, refresh_margin: float):
+        self.refresh_margin = refresh_margin
+        self._creds: Optional[Credentials] = None
+        self._service = None
+        self._saved_token: Optional[str] = None
+        self._lock = threading.Lock()
+        # httplib2 is not thread safe, so every dispatcher thread gets its own connection
+        self._local = threading.local()
+        self._stop = threading.Event()
+        self._refresher: Optional[threading.Thread] = None
+
+    def start(self):
+        with self._lock:
+            if self._service:
+                return
+            self._creds = self._load_credentials()
+            self._service = build(
+                "calendar",
+                "v3",
+                credentials=self._creds,
+                static_discovery=True,
+                cache_discovery=False,
+            )
+        self._stop.clear()
+        self._refresher = threading.Thread(
+            target=self._refresh_loop, name="calendar-token-refresh", daemon=True
+        )
+        self._refresher.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def insert_event(self, event: dict) -> dict:
+        self.start()
+        return (
+            self._service.events()
+            .insert(calendarId="primary", body=event)
+            .execute(http=self._http())
+        )
+
+    def _http(self) -> AuthorizedHttp:
+        http = getattr(self._local, "http", None)
+        if http is None:
+            http = AuthorizedHttp(self._creds, http=httplib2.Http())
+            self._local.http = http
+        return http
+
+    def _load_credentials(self) -> Credentials:
+        creds = None
+        # The file token.json stores the user's access and refresh tokens, and is
+        # created automatically when the authorization flow completes for the first
+        # time.
+        if os.path.exists(TOKEN_FILE):
+            creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
+            self._saved_token = creds.to_json()
+        # If there are no (valid) credentials available, let the user log in.
+        if not creds or not creds.valid:
+            if creds and creds.expired and creds.refresh_token:
+                creds.refresh(Request())
+            else:
+                flow = InstalledAppFlow.from_client_secrets_file(
+                    CREDENTIALS_FILE, SCOPES
+                )
+                creds = flow.run_local_server(port=0)
+        self._save(creds)
+        return creds
+
+    # Only touches token.json when the token actually changed
+    def _save(self, creds: Credentials):
+        token = creds.to_json()
+        if token == self._saved_token:
+            return
+        with open(TOKEN_FILE, "w") as token_file:
+            token_file.write(token)
+        self._saved_token = token
+
+    def _seconds_until_refresh(self) -> float:
+        if not self._creds.expiry:
+            return self.refresh_margin
+        # google-auth keeps expiry as a naive UTC datetime
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        remaining = (self._creds.expiry - now).total_seconds()
+        return max(remaining - self.refresh_margin, 0)
 
+    def _refresh_loop(self):
+        while not self._stop.wait(self._seconds_until_refresh()):
+            try:
+                with self._lock:
+                    self._creds.refresh(Request())
+                    self._save(self._creds)
+            except Exception as error:
+                print(f"Calendar token refresh failed: {error}")
+                if self._stop.wait(60):
+                    break
+
+
+# Keeps events in memory instead of sending them anywhere
+class RecorderSink(CalendarSink):
+    def __init__(self, size: int):
+        self.events: deque[dict] = deque(maxlen=size)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def insert_event(self, event: dict) -> dict:
+        with self._lock:
+            event = {**event, "id": str(next(self._ids))}
+            self.events.append(event)
+        event["htmlLink"] = f"recorder://events/{event['id']}"
+        return event
+
+
+# Sends events through the real googleapiclient request path, but to a local
+# stand-in for events().insert such as fake_calendar.py, without credentials
+class HttpSink(CalendarSink):
+    def __init__(self, url: str):
+        self.url = url
+        self._service = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def start(self):
+        with self._lock:
+            if self._service:
+                return
+            self._service = build(
+                "calendar",
+                "v3",
+                http=httplib2.Http(),
+                static_discovery=True,
+                cache_discovery=False,
+                client_options={"api_endpoint": self.url},
+            )
+
+    def insert_event(self, event: dict) -> dict:
+        self.start()
+        http = getattr(self._local, "http", None)
+        if http is None:
+            http = httplib2.Http()
+            self._local.http = http
+        return (
+            self._service.events()
+            .insert(calendarId="primary", body=event)
+            .execute(http=http)
+        )
+
+
+def make_sink(kind: str) -> CalendarSink:
+    if kind == "google":
+        return GoogleSink(CALENDAR_REFRESH_MARGIN)
+    if kind == "recorder":
+        return RecorderSink(CALENDAR_RECORDER_SIZE)
+    if kind == "http":
+        return HttpSink(CALENDAR_FAKE_URL)
+    raise ValueError(f"Unknown CALENDAR_SINK {kind!r}")
+
+
+client = make_sink(CALENDAR_SINK)
+
+
+def notify(todo_list: list[str], sink: Optional[CalendarSink] = None) -> str:
+    """Creates a Calendar event listing the todo items and returns its link.
+    Blocking, so callers on the event loop should go through dispatcher.
+    """
     try:
-        service = build("calendar", "v3", credentials=creds)
         # The calendar doesn't notify properly bruh
 
         # Call the Calendar API
@@ -68,7 +248,9 @@ def notify(todo_list: list[str]):
             },
         }
 
-        event = service.events().insert(calendarId="primary", body=event).execute()
+        event = (sink or client).insert_event(event)
         print("Event created: %s" % (event.get("htmlLink")))
+        return event.get("htmlLink")
     except HttpError as error:
         print(f"An error occurred: {error}")
+        raise
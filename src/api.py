@@ -1,25 +1,39 @@
-# Maybe should create individual databases for each user
-
-from fastapi import FastAPI, HTTPException, Depends, Response, Request, status
-from fastapi.responses import StreamingResponse
-from typing import Annotated, Optional
+from fastapi import FastAPI, HTTPException, Depends, Query, Response, Request, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse, ORJSONResponse
+from typing import Annotated, AsyncIterator, Literal, Optional
 from fastapi.security import HTTPBearer, HTTPBasicCredentials
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.base import BaseHTTPMiddleware
-from pydantic import BaseModel
-from databaseinit import Get_DB, Get_Users, Get_Whitelist
+from pydantic import BaseModel, Field, model_validator
+from databaseinit import Create_Tables, Get_Users, Get_Whitelist
 from db_models.user_models import User_DB
-from db_models.db_models import Event, Todo
+from db_models.db_models import Event, Outbox, Todo
 from db_models.whitelist_models import Whitelist_DB
 from sqlalchemy import select, update, delete, insert
 from sqlalchemy.ext.asyncio import AsyncSession
+from contextlib import asynccontextmanager
 import time
 import datetime
+from dispatcher import dispatcher
+import export
+from outbox import drainer
+from retention import retention
+from shards import Get_Shard, Get_Shard_DB, Shard, default_shard, shard_cache, shard_of
+import shards
+import outbox
+import stats
+import schemas
+import versions
+from whitelist import IP_WHITELIST_ENABLED, ip_whitelist, parse_entry
 import NotifyCalendar as NotifyCalendar
 import auth
-import pyotp
-import qrcode
-import io
+import login_tickets
+import otp_qr
+import passwords
+import refresh_tokens
+import asyncio
 from dotenv import load_dotenv
 import os
 
@@ -27,26 +41,62 @@ load_dotenv(dotenv_path="../.env")
 BACKEND_URL = os.getenv("BACKEND_URL")
 FRONTEND_URL = os.getenv("FRONTEND_URL")
 FRONTEND_HOST = os.getenv("FRONTEND_HOST")
+# Max device messages accepted by one /notify/batch call
+NOTIFY_BATCH_MAX = int(os.getenv("NOTIFY_BATCH_MAX", "1000"))
+# Max operations accepted by one /todo/bulk call
+TODO_BULK_MAX = int(os.getenv("TODO_BULK_MAX", "1000"))
+# Default and largest page size of the /todo/ and /events/ listings
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "100"))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "1000"))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await Create_Tables()
+    await ip_whitelist.load()
+    passwords.pool.start()
+    async with default_shard.session() as db:
+        await default_shard.todos.rows(db)
+    whitelist_refresh = asyncio.create_task(ip_whitelist.refresh_forever())
+    # Warm up the Calendar client in the background, the OAuth flow may wait on a browser
+    warmup = asyncio.create_task(asyncio.to_thread(prewarm_calendar))
+    draining = asyncio.create_task(drainer.run())
+    purging = asyncio.create_task(retention.run_forever())
+    sweeping = asyncio.create_task(shards.sweep_forever())
+    yield
+    background = [purging, sweeping, warmup, whitelist_refresh]
+    for task in background:
+        task.cancel()
+    await asyncio.gather(*background, return_exceptions=True)
+    await drainer.shutdown(draining)
+    await shard_cache.close_all()
+    NotifyCalendar.client.stop()
+    passwords.pool.shutdown()
+    dispatcher.shutdown()
+
+
+def prewarm_calendar():
+    try:
+        NotifyCalendar.client.start()
+    except Exception as error:
+        print(f"Calendar client warmup failed: {error}")
 
 
-# Singleton class for storing temporary data, I don't think it is unique to every user so it should actually instead be able to have many instancs
-class temp_storage(BaseModel):
-    temp_login_response: Optional[auth.Login_Response] = None
-    temp_login: Optional[auth.Login] = None
-    ip_whitelist: list[str] = [""]
-
-    def __new__(cls):
-        if not hasattr(cls, "instance"):
-            cls.instance = super().__new__(cls)
-        return cls.instance
-
+# orjson renders the validated response models, much faster than the stock encoder
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
-temp = temp_storage()
+bearer_security = HTTPBearer()
 
 
-app = FastAPI()
+# Validation errors echo the rejected input, which may be a float JSON cannot carry
+# (Infinity, NaN). orjson writes those as null where the default handler would fail.
+@app.exception_handler(RequestValidationError)
+async def validation_error(request: Request, exc: RequestValidationError):
+    return ORJSONResponse(
+        status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+        content={"detail": jsonable_encoder(exc.errors())},
+    )
 
-bearer_security = HTTPBearer()
 
 app.add_middleware(
     CORSMiddleware,
@@ -56,118 +106,406 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
-# Does not work in the container. TODO: Change to API key authentication
-"""
+
+# Checked against the in-memory whitelist index, so no database access per request.
+# TODO: Change to API key authentication, client IPs are not reliable behind proxies.
 @app.middleware("http")
 async def validate_ip(request: Request, call_next):
-  whitelist = Get_Whitelist()
-  results = whitelist.execute(select(Whitelist_DB))
-  list_of_entries = results.scalars().all()
-  temp.ip_whitelist = [entry.ip for entry in list_of_entries]
-  temp.ip_whitelist.append(FRONTEND_HOST)
-  if request.client.host not in temp.ip_whitelist:
-    raise HTTPException(status_code=status.HTTP_403_FORBIDDEN)
-  response = await call_next(request)
-  return response
-"""
-
-
-@app.get("/todo/")
-async def todo_root(todos: AsyncSession = Depends(Get_DB)):
-    results = await todos.execute(select(Todo))
-    todo_list = results.scalars().all()
-    return {"Here's a list of things you need to do:": todo_list}
-
-
-@app.post("/todo/add/")
+    if IP_WHITELIST_ENABLED:
+        host = request.client.host if request.client else None
+        if host != FRONTEND_HOST and host not in ip_whitelist:
+            return JSONResponse(
+                status_code=status.HTTP_403_FORBIDDEN, content={"detail": "Forbidden"}
+            )
+    return await call_next(request)
+
+
+# Listings are paged on rowid: pass the returned next_cursor back as cursor to get the
+# rows after it, next_cursor is null on the last page
+def next_cursor(rows: list, limit: int) -> int | None:
+    return rows[-1].rowid if len(rows) == limit else None
+
+
+# Listings are tagged with their table's version, per database since users each have
+# their own. A client sending the tag back in If-None-Match gets a 304 while the table
+# is unchanged.
+def version_etag(shard: Shard, table: str, version: int) -> str:
+    return f'W/"{shard.name}-{table}-{version}"'
+
+
+def not_modified(request: Request, etag: str) -> Optional[Response]:
+    tags = [tag.strip() for tag in request.headers.get("If-None-Match", "").split(",")]
+    if etag in tags or "*" in tags:
+        return Response(
+            status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag}
+        )
+    return None
+
+
+@app.get("/todo/", response_model=schemas.TodoPage)
+async def todo_root(
+    request: Request,
+    response: Response,
+    cursor: int | None = None,
+    limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    todos: AsyncSession = Depends(Get_Shard_DB),
+):
+    shard = shard_of(todos)
+    todo_list = await shard.todos.page(todos, cursor, limit)
+    etag = version_etag(shard, Todo.__tablename__, shard.todos.version)
+    if unchanged := not_modified(request, etag):
+        return unchanged
+    response.headers["ETag"] = etag
+    return schemas.TodoPage(todos=todo_list, next_cursor=next_cursor(todo_list, limit))
+
+
+# Todo changes go through the shard's todo cache, which commits them
+@app.post("/todo/add/", response_model=list[schemas.TodoOut])
 async def add_todo(
-    description: str, bRepeats: bool, todos: AsyncSession = Depends(Get_DB)
+    description: str, bRepeats: bool, todos: AsyncSession = Depends(Get_Shard_DB)
 ):
-    await todos.execute(insert(Todo).values(description=description, bRepeats=bRepeats))
-    await todos.commit()
-    return
+    results = await todos.execute(
+        insert(Todo).values(description=description, bRepeats=bRepeats).returning(Todo)
+    )
+    rows = results.scalars().all()
+    await shard_of(todos).todos.commit(todos, upserted=rows)
+    return rows
 
 
-@app.put("/todo/update/{rowid}")
+@app.put("/todo/update/{rowid}", response_model=list[schemas.TodoOut])
 async def update_todo(
     rowid: int | None = None,
     description: str | None = None,
     bRepeats: bool | None = None,
-    todos: AsyncSession = Depends(Get_DB),
+    todos: AsyncSession = Depends(Get_Shard_DB),
 ):
-    await todos.execute(
+    results = await todos.execute(
         update(Todo)
         .where(Todo.rowid == rowid)
         .values(description=description, bRepeats=bRepeats)
+        .returning(Todo)
+        .execution_options(synchronize_session=False)
     )
-    await todos.commit()
-    return
+    rows = results.scalars().all()
+    await shard_of(todos).todos.commit(todos, upserted=rows)
+    return rows
 
 
-@app.delete("/todo/delete/")
+@app.delete("/todo/delete/", response_model=schemas.Message)
 async def delete_todo_by_description(
-    description: str, todos: AsyncSession = Depends(Get_DB)
+    description: str, todos: AsyncSession = Depends(Get_Shard_DB)
 ):
-    await todos.execute(delete(Todo).where(Todo.description == description))
-    await todos.commit()
+    results = await todos.execute(
+        delete(Todo).where(Todo.description == description).returning(Todo.rowid)
+    )
+    await shard_of(todos).todos.commit(todos, removed=results.scalars().all())
     return {"message": f"Todo with description '{description}' deleted successfully"}
 
 
-@app.delete("/todo/delete/{rowid}")
-async def delete_todo_by_id(rowid: int, todos: AsyncSession = Depends(Get_DB)):
-    await todos.execute(delete(Todo).where(Todo.rowid == rowid))
-    await todos.commit()
+@app.delete("/todo/delete/{rowid}", response_model=schemas.Message)
+async def delete_todo_by_id(rowid: int, todos: AsyncSession = Depends(Get_Shard_DB)):
+    results = await todos.execute(
+        delete(Todo).where(Todo.rowid == rowid).returning(Todo.rowid)
+    )
+    await shard_of(todos).todos.commit(todos, removed=results.scalars().all())
     return {"message": f"Todo with id {rowid} deleted successfully"}
 
 
-@app.post("/notify/")
-async def notify(message: str | None = None, db: AsyncSession = Depends(Get_DB)):
-    # Store the list of todo messages in a list of strings
-    results = await db.execute(select(Todo))
-    todo_list = results.scalars().all()
-    todo_list = [entry.description for entry in todo_list]
+class TodoOperation(BaseModel):
+    op: Literal["create", "update", "delete"]
+    # Required by update and delete
+    rowid: int | None = None
+    # Required by create, update only changes the fields that are given
+    description: str | None = None
+    bRepeats: bool | None = None
+
+    @model_validator(mode="after")
+    def check_fields(self):
+        if self.op == "create" and (self.description is None or self.bRepeats is None):
+            raise ValueError("create needs description and bRepeats")
+        if self.op != "create" and self.rowid is None:
+            raise ValueError(f"{self.op} needs rowid")
+        return self
+
+
+# Applies the operations as if one after another, but with one statement per kind:
+# updates, then deletes, then inserts. Returns a result per operation in input order.
+async def apply_todo_operations(
+    db: AsyncSession, operations: list[TodoOperation]
+) -> list[dict]:
+    targets = {operation.rowid for operation in operations if operation.op != "create"}
+    existing = set()
+    if targets:
+        results = await db.execute(select(Todo.rowid).where(Todo.rowid.in_(targets)))
+        existing = set(results.scalars().all())
+
+    outcomes = []
+    updates: dict[int, dict] = {}
+    deletes = []
+    creates = []
+    for operation in operations:
+        if operation.op == "create":
+            outcomes.append({"op": "create", "status": "created"})
+            creates.append(
+                {"description": operation.description, "bRepeats": operation.bRepeats}
+            )
+            continue
+        outcome = {"op": operation.op, "rowid": operation.rowid}
+        outcomes.append(outcome)
+        if operation.rowid not in existing:
+            outcome["status"] = "not_found"
+        elif operation.op == "update":
+            values = updates.setdefault(operation.rowid, {"rowid": operation.rowid})
+            values.update(
+                operation.model_dump(
+                    include={"description", "bRepeats"}, exclude_none=True
+                )
+            )
+            outcome["status"] = "updated"
+        else:
+            # Later operations on this rowid find it gone, an earlier update is moot
+            existing.discard(operation.rowid)
+            updates.pop(operation.rowid, None)
+            deletes.append(operation.rowid)
+            outcome["status"] = "deleted"
+
+    # Bulk UPDATE by primary key, executemany grouped by the columns each row sets
+    changes = [values for values in updates.values() if len(values) > 1]
+    upserted = []
+    if changes:
+        await db.execute(update(Todo), changes)
+        results = await db.execute(
+            select(Todo).where(Todo.rowid.in_([values["rowid"] for values in changes]))
+        )
+        upserted.extend(results.scalars().all())
+    # Inserted before the deletes, so SQLite cannot hand a new todo the rowid of one
+    # deleted in the same batch
+    if creates:
+        results = await db.execute(
+            insert(Todo).returning(Todo, sort_by_parameter_order=True), creates
+        )
+        created = results.scalars().all()
+        upserted.extend(created)
+        rowids = iter(todo.rowid for todo in created)
+        for outcome in outcomes:
+            if outcome["op"] == "create":
+                outcome["rowid"] = next(rowids)
+    if deletes:
+        await db.execute(delete(Todo).where(Todo.rowid.in_(deletes)))
+    await shard_of(db).todos.commit(db, upserted=upserted, removed=deletes)
+    return outcomes
+
+
+# Create, update and delete todos in one transaction, e.g.
+# [{"op": "create", "description": "Water plants", "bRepeats": true}, {"op": "delete", "rowid": 3}]
+@app.post("/todo/bulk", response_model=schemas.TodoBulkResult)
+async def bulk_todo(
+    operations: list[TodoOperation], todos: AsyncSession = Depends(Get_Shard_DB)
+):
+    if not operations:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="No operations"
+        )
+    if len(operations) > TODO_BULK_MAX:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"At most {TODO_BULK_MAX} operations per batch",
+        )
+    outcomes = await apply_todo_operations(todos, operations)
+    return {
+        "results": outcomes,
+        "rowids": [
+            outcome["rowid"] for outcome in outcomes if outcome["op"] == "create"
+        ],
+    }
+
+
+# Last second datetime.fromtimestamp accepts in any time zone, 9999-12-31 00:00 UTC
+MAX_TIMESTAMP = 253402214400
+
+
+class DeviceMessage(BaseModel):
+    message: str | None = None
+    # Seconds since the epoch, defaults to when the server receives it
+    timestamp: float | None = Field(None, ge=0, le=MAX_TIMESTAMP, allow_inf_nan=False)
+
+
+# Records one Event per message and queues a single Calendar notification for all of
+# them, everything in one transaction. Returns the new events and the outbox dispatch id.
+async def record_notifications(
+    db: AsyncSession, messages: list[DeviceMessage]
+) -> tuple[list[Event], int]:
+    # Add the entries to the events table with one executemany
+    now = time.time()
+    rows = []
+    for device_message in messages:
+        raw_timestamp = (
+            now if device_message.timestamp is None else device_message.timestamp
+        )
+        rows.append(
+            {
+                "timestamp": str(datetime.datetime.fromtimestamp(raw_timestamp)),
+                "raw_timestamp": raw_timestamp,
+                "description": f"Notification: {device_message.message}",
+            }
+        )
+    results = await db.execute(
+        insert(Event).returning(Event, sort_by_parameter_order=True), rows
+    )
+    entries = list(results.scalars().all())
+    await stats.record(db, ((row["raw_timestamp"], row["description"]) for row in rows))
+    events_version = await versions.bump(db, Event.__tablename__)
+
+    # Store the list of todo messages in a list of strings, from the todo cache. Read after
+    # the insert so a cache reload cannot be refused SQLite's write lock upgrade.
+    todos = await shard_of(db).todos.rows(db)
+    todo_list = [todo.description for todo in todos]
+
+    # Queue the Google Calendar call in the same transaction, poll /notify/status/ for the result
+    dispatch = await outbox.enqueue(db, todo_list, event_rowid=entries[-1].rowid)
+
+    # Remove the non-repeating entries that were sent. The cache may be a little behind
+    # other workers, whose new todos are left for the next notification.
+    sent = [todo.rowid for todo in todos if not todo.bRepeats]
+    results = await db.execute(
+        delete(Todo)
+        .where(Todo.rowid.in_(sent), Todo.bRepeats.is_(False))
+        .returning(Todo.rowid)
+    )
+    await shard_of(db).todos.commit(db, removed=results.scalars().all())
+    shard_of(db).events.note(events_version)
+    shard_of(db).drainer.wake()
+    return entries, dispatch
 
-    # Add an API call to Google Calendar
-    NotifyCalendar.notify(todo_list)
 
-    # Add an entry to the events table
-    await db.execute(
-        insert(Event).values(
-            timestamp=datetime.datetime.now(),
-            raw_timestamp=time.time(),
-            description=f"Notification: {message}",
-        )
+@app.post("/notify/", response_model=schemas.NotifyResult)
+async def notify(message: str | None = None, db: AsyncSession = Depends(Get_Shard_DB)):
+    entries, dispatch = await record_notifications(
+        db, [DeviceMessage(message=message)]
     )
+    return schemas.NotifyResult(latest_entry=entries[0], dispatch=dispatch)
 
-    # Remove the non-repeating entries in todo
-    await db.execute(delete(Todo).where(Todo.bRepeats == 0))
 
-    await db.commit()
+@app.post("/notify/batch", response_model=schemas.NotifyBatchResult)
+async def notify_batch(
+    messages: list[DeviceMessage], db: AsyncSession = Depends(Get_Shard_DB)
+):
+    if not messages:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="No messages"
+        )
+    if len(messages) > NOTIFY_BATCH_MAX:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"At most {NOTIFY_BATCH_MAX} messages per batch",
+        )
+    entries, dispatch = await record_notifications(db, messages)
+    return {"rowids": [entry.rowid for entry in entries], "dispatch": dispatch}
+
 
-    # Select and print the latest entry
-    results = await db.execute(select(Event).order_by(Event.rowid.desc()).limit(1))
-    entry = results.scalars().first()
+@app.get("/notify/status/{dispatch_id}", response_model=schemas.OutboxOut)
+async def notify_status(dispatch_id: int, db: AsyncSession = Depends(Get_Shard_DB)):
+    results = await db.execute(select(Outbox).where(Outbox.rowid == dispatch_id))
+    dispatch = results.scalars().first()
+    if not dispatch:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Unknown dispatch id"
+        )
+    return dispatch
 
-    return {"Latest entry: ": entry}
 
+@app.get("/notify/outbox/", response_model=dict[str, int])
+async def outbox_counts(db: AsyncSession = Depends(Get_Shard_DB)):
+    return await outbox.counts(db)
 
-@app.get("/events/")
-async def events_root(events: AsyncSession = Depends(Get_DB)):
-    results = await events.execute(select(Event))
-    return {"Here's a list of notify events:": results.scalars().all()}
 
+# since and until are epoch seconds compared against raw_timestamp, until is exclusive
+@app.get("/events/", response_model=schemas.EventPage)
+async def events_root(
+    request: Request,
+    response: Response,
+    cursor: int | None = None,
+    limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    since: float | None = None,
+    until: float | None = None,
+    events: AsyncSession = Depends(Get_Shard_DB),
+):
+    shard = shard_of(events)
+    etag = version_etag(shard, Event.__tablename__, await shard.events.get(events))
+    if unchanged := not_modified(request, etag):
+        return unchanged
+    response.headers["ETag"] = etag
+    query = select(Event).order_by(Event.rowid).limit(limit)
+    if cursor is not None:
+        query = query.where(Event.rowid > cursor)
+    if since is not None:
+        query = query.where(Event.raw_timestamp >= since)
+    if until is not None:
+        query = query.where(Event.raw_timestamp < until)
+    results = await events.execute(query)
+    event_list = results.scalars().all()
+    return schemas.EventPage(
+        events=event_list, next_cursor=next_cursor(event_list, limit)
+    )
 
-@app.delete("/events/delete/{rowid}")
-async def delete_event_by_id(rowid: int, events: AsyncSession = Depends(Get_DB)):
-    await events.execute(delete(Event).where(Event.rowid == rowid))
+
+# Event counts per time bucket and per description, read from the counters kept by /notify/
+@app.get("/events/stats", response_model=schemas.EventStats)
+async def events_stats(
+    granularity: str = Query("hour", pattern="^(minute|hour|day)$"),
+    since: float | None = None,
+    until: float | None = None,
+    description: str | None = None,
+    events: AsyncSession = Depends(Get_Shard_DB),
+):
+    return await stats.summary(events, granularity, since, until, description)
+
+
+# Full event history as NDJSON or CSV, sent while the query is still running
+@app.get("/events/export")
+async def export_events(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    since: float | None = None,
+    until: float | None = None,
+    chunk_size: int = Query(
+        export.EXPORT_CHUNK_SIZE, ge=1, le=export.MAX_EXPORT_CHUNK_SIZE
+    ),
+    shard: Shard = Depends(Get_Shard),
+):
+    media_type = export.FORMATS[format][0]
+    return shards.stream_from(
+        shard,
+        export.stream_events(
+            shard.session_factory, export.event_query(since, until), format, chunk_size
+        ),
+        media_type=media_type,
+        headers={
+            "Content-Disposition": f'attachment; filename="events.{format}"'
+        },
+    )
+
+
+@app.delete("/events/delete/{rowid}", response_model=schemas.Message)
+async def delete_event_by_id(rowid: int, events: AsyncSession = Depends(Get_Shard_DB)):
+    results = await events.execute(
+        delete(Event)
+        .where(Event.rowid == rowid)
+        .returning(Event.raw_timestamp, Event.description)
+    )
+    deleted = results.all()
+    if deleted:
+        await stats.record(events, deleted, sign=-1)
+        version = await versions.bump(events, Event.__tablename__)
     await events.commit()
+    if deleted:
+        shard_of(events).events.note(version)
     return {"message": f"Event with id {rowid} deleted successfully"}
 
 
 # Authentication below:
 
 
-@app.post("/auth/register/")
+@app.post("/auth/register/", response_model=bool)
 async def register(
     username: str, password: str, users: AsyncSession = Depends(Get_Users)
 ):
@@ -181,7 +519,7 @@ async def register(
         return False
 
 
-@app.put("/auth/otp/enable/")
+@app.put("/auth/otp/enable/", response_model=schemas.Message)
 async def enable_otp(request: Request, users: AsyncSession = Depends(Get_Users)):
     try:
         token = request.cookies.get("token")
@@ -198,6 +536,7 @@ async def enable_otp(request: Request, users: AsyncSession = Depends(Get_Users))
             .values(otp_enabled=True)
         )
         await users.commit()
+        auth.user_cache.invalidate(user.username)
         return {"message": f"OTP enabled for user {user.username}"}
     except HTTPException:
         raise HTTPException(
@@ -207,7 +546,7 @@ async def enable_otp(request: Request, users: AsyncSession = Depends(Get_Users))
         )
 
 
-@app.put("/auth/otp/disable/")
+@app.put("/auth/otp/disable/", response_model=schemas.Message)
 async def disable_otp(request: Request, users: AsyncSession = Depends(Get_Users)):
     try:
         token = request.cookies.get("token")
@@ -225,6 +564,7 @@ async def disable_otp(request: Request, users: AsyncSession = Depends(Get_Users)
             .values(otp_enabled=False)
         )
         await users.commit()
+        auth.user_cache.invalidate(user.username)
         return {"message": f"OTP disabled for user {user.username}"}
     except HTTPException:
         print(HTTPException + "Get current user failed")
@@ -235,28 +575,33 @@ async def disable_otp(request: Request, users: AsyncSession = Depends(Get_Users)
         )
 
 
+# Rendered once per user and secret, revisits are answered from otp_qr.qr_cache or
+# with a 304. Private, the image carries the OTP secret.
 @app.get("/auth/otp/generate/")
-async def generate_qr_code(request: Request, users: AsyncSession = Depends(Get_Users)):
+async def generate_qr_code(
+    request: Request,
+    format: otp_qr.Format = "png",
+    users: AsyncSession = Depends(Get_Users),
+):
     try:
-        user: auth.user = await auth.get_current_user(
+        user: auth.User = await auth.get_current_user(
             request.cookies.get("token"), users=users
         )
-        totp = pyotp.TOTP(user.secret_key)
-        qr_code = qrcode.make(
-            totp.provisioning_uri(
-                user.username, issuer_name="An Embedded System Web App"
-            )
-        )
-        img_byte_array = io.BytesIO()
-        qr_code.save(img_byte_array)
-        img_byte_array.seek(0)  # Reset the buffer position to the beginning
-        return StreamingResponse(content=img_byte_array, media_type="image/png")
     except HTTPException:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    etag = otp_qr.etag(user.username, user.secret_key, format)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if unchanged := not_modified(request, etag):
+        unchanged.headers.update(headers)
+        return unchanged
+    image = await otp_qr.qr_cache.get(user.username, user.secret_key, format)
+    return Response(
+        content=image, media_type=otp_qr.MEDIA_TYPES[format], headers=headers
+    )
 
 
 @app.get("/auth/token/read/")
@@ -265,7 +610,7 @@ def read_token(request: Request):
     return token_value
 
 
-@app.get("/auth/token/verify/")
+@app.get("/auth/token/verify/", response_model=schemas.UserView)
 async def verify_user(request: Request, users: AsyncSession = Depends(Get_Users)):
     if not request.cookies.get("token"):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
@@ -276,96 +621,317 @@ async def verify_user(request: Request, users: AsyncSession = Depends(Get_Users)
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
 
 
-@app.get("/auth/login/")
+def set_login_ticket(response: Response, ticket: str):
+    response.set_cookie(
+        key=login_tickets.COOKIE,
+        value=ticket,
+        max_age=login_tickets.LOGIN_TICKET_TTL,
+        httponly=True,
+        samesite="lax",
+        secure=True,
+    )
+
+
+# Times the steps of a login request, failed ones included, into auth.login_timings.
+# Successful responses also carry them in a Server-Timing header.
+async def Get_Login_Timings() -> AsyncIterator[auth.LoginTimings]:
+    timings = auth.LoginTimings()
+    try:
+        yield timings
+    finally:
+        auth.login_timings.add(timings)
+
+
+# The password step hands out a login ticket cookie, the OTP and token steps continue
+# whichever login it belongs to
+@app.get("/auth/login/", response_model=auth.Login_Response)
 async def login_normal(
-    username: str, password: str, users: AsyncSession = Depends(Get_Users)
+    response: Response,
+    username: str,
+    password: str,
+    users: AsyncSession = Depends(Get_Users),
+    timings: auth.LoginTimings = Depends(Get_Login_Timings),
 ):
     credentials: Annotated[
         HTTPBasicCredentials, Depends(auth.basic_security)
     ] = HTTPBasicCredentials(username=username, password=password)
-    attempted_login = await auth.get_login(credentials=credentials, users=users)
+    attempted_login = await auth.get_login(
+        credentials=credentials, users=users, timings=timings
+    )
     if attempted_login.status == auth.ErrorCode.INVALID_CREDENTIALS:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    login_response = await auth.get_login_response(attempted_login, users=users)
-    temp.temp_login = attempted_login
-    temp.temp_login_response = login_response
+    login_response = await auth.get_login_response(
+        attempted_login.user, timings=timings
+    )
+    ticket = login_tickets.new_ticket()
+    with timings.step("ticket"):
+        await login_tickets.tickets.put(
+            ticket,
+            login_tickets.PendingLogin(
+                username=attempted_login.user.username,
+                status=login_response.status,
+                origin=login_tickets.PASSWORD,
+            ),
+        )
+    set_login_ticket(response, ticket)
+    response.headers["Server-Timing"] = timings.header()
     return login_response
 
 
-@app.get("/auth/login/otp/")
+@app.get("/auth/login/otp/", response_model=auth.Login_Response)
 async def login_otp(
+    request: Request,
+    response: Response,
     users: AsyncSession = Depends(Get_Users),
     otp: Optional[str] = None,
     enabling_otp: bool = False,
+    timings: auth.LoginTimings = Depends(Get_Login_Timings),
 ):
-    if enabling_otp and (
-        temp.temp_login_response.status == auth.ErrorCode.SUCCESS
-        or temp.temp_login_response.status == auth.ErrorCode.INVALID_OTP
-    ):
-        temp.temp_login_response.status = auth.ErrorCode.OTP_REQUIRED
-    login_response = temp.temp_login_response
-    login = temp.temp_login
-    if not login_response:
+    ticket = request.cookies.get(login_tickets.COOKIE)
+    with timings.step("ticket"):
+        pending = await login_tickets.tickets.get(ticket) if ticket else None
+    user: Optional[auth.User] = None
+    if enabling_otp:
+        if pending is None:
+            # Enabling or disabling OTP long after the login, go by the session token.
+            # Only the OTP is checked, no ticket is kept that could be traded for a token.
+            token = shards.token_of(request)
+            if not token:
+                raise HTTPException(
+                    status_code=status.HTTP_401_UNAUTHORIZED,
+                    detail="Invalid credentials",
+                    headers={"WWW-Authenticate": "Bearer"},
+                )
+            with timings.step("db"):
+                user = await auth.get_current_user(token, users=users)
+            ticket = None
+            pending = login_tickets.PendingLogin(
+                username=user.username, status=auth.ErrorCode.OTP_REQUIRED
+            )
+        elif (
+            pending.status == auth.ErrorCode.SUCCESS
+            or pending.status == auth.ErrorCode.INVALID_OTP
+        ):
+            pending.status = auth.ErrorCode.OTP_REQUIRED
+    if not pending:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid credentials",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    if (login_response.status != auth.ErrorCode.OTP_REQUIRED) and (
-        login_response.status != auth.ErrorCode.INVALID_OTP
+    if (pending.status != auth.ErrorCode.OTP_REQUIRED) and (
+        pending.status != auth.ErrorCode.INVALID_OTP
     ):
-        print(login_response.status)
+        print(pending.status)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="OTP not enabled or invalid credentials",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    response = await auth.get_login_response(login, otp=otp, users=users)
-    if response.status == auth.ErrorCode.INVALID_OTP:
-        print(login_response.status)
+    if user is None:
+        with timings.step("db"):
+            user = await auth.load_user(pending.username, users)
+        if user is None:
+            raise HTTPException(status_code=400, detail="User does not exist")
+    login_response = await auth.get_login_response(user, otp=otp, timings=timings)
+    pending.status = login_response.status
+    if ticket:
+        with timings.step("ticket"):
+            await login_tickets.tickets.put(ticket, pending)
+    if login_response.status == auth.ErrorCode.INVALID_OTP:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid OTP",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    temp.temp_login_response = response
-    return response
+    response.headers["Server-Timing"] = timings.header()
+    return login_response
 
 
-@app.get("/auth/login/token/")
-async def login_for_token(response: Response):
-    login_response = temp.temp_login_response
-    if login_response.status != auth.ErrorCode.SUCCESS:
-        print(login_response.status)
+# Ends the login ticket, the session token goes in its own cookie. The user was
+# checked by the earlier steps, so it is not looked up again.
+@app.get("/auth/login/token/", response_model=schemas.Message)
+async def login_for_token(
+    request: Request,
+    response: Response,
+    users: AsyncSession = Depends(Get_Users),
+    timings: auth.LoginTimings = Depends(Get_Login_Timings),
+):
+    ticket = request.cookies.get(login_tickets.COOKIE)
+    with timings.step("ticket"):
+        pending = await login_tickets.tickets.pop_finished(ticket) if ticket else None
+    if not pending:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    with timings.step("jwt"):
+        token = auth.create_jwt({"sub": pending.username})
+    with timings.step("db"):
+        refresh_token = await refresh_tokens.issue(users, pending.username)
+    set_session_cookies(response, token, refresh_token)
+    response.delete_cookie(
+        key=login_tickets.COOKIE, httponly=True, samesite="lax", secure=True
+    )
+    response.headers["Server-Timing"] = timings.header()
+    return {"message": "Token set"}
+
+
+def set_session_cookies(response: Response, token: str, refresh_token: str):
     response.set_cookie(
         key="token",
-        value=login_response.token,
+        value=token,
         httponly=True,
         samesite="lax",
         secure=True,
     )
-    return {"message": "Token set"}
+    response.set_cookie(
+        key=refresh_tokens.COOKIE,
+        value=refresh_token,
+        max_age=int(refresh_tokens.REFRESH_TOKEN_DAYS * 86400),
+        path=refresh_tokens.COOKIE_PATH,
+        httponly=True,
+        samesite="lax",
+        secure=True,
+    )
+
+
+def clear_session_cookies(response: Response):
+    response.delete_cookie(key="token", httponly=True, samesite="lax", secure=True)
+    response.delete_cookie(
+        key=refresh_tokens.COOKIE,
+        path=refresh_tokens.COOKIE_PATH,
+        httponly=True,
+        samesite="lax",
+        secure=True,
+    )
+
+
+# Trades the refresh token cookie for a new access token and refresh token, so the
+# password is only needed once per REFRESH_TOKEN_DAYS
+@app.post("/auth/token/refresh/", response_model=schemas.Message)
+async def refresh_token(
+    request: Request,
+    response: Response,
+    users: AsyncSession = Depends(Get_Users),
+    timings: auth.LoginTimings = Depends(Get_Login_Timings),
+):
+    presented = request.cookies.get(refresh_tokens.COOKIE)
+    with timings.step("db"):
+        rotated = await refresh_tokens.rotate(users, presented) if presented else None
+        if rotated is not None:
+            user = await auth.load_user(rotated[0], users)
+            if user is None or user.disabled:
+                await refresh_tokens.revoke(users, rotated[1])
+                rotated = None
+    if rotated is None:
+        unauthorized = JSONResponse(
+            {"detail": "Invalid refresh token"},
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+        clear_session_cookies(unauthorized)
+        return unauthorized
+    username, refresh_token = rotated
+    with timings.step("jwt"):
+        token = auth.create_jwt({"sub": username})
+    set_session_cookies(response, token, refresh_token)
+    response.headers["Server-Timing"] = timings.header()
+    return {"message": "Token refreshed"}
+
+
+# Logs out: revokes the refresh token and clears both cookies
+@app.post("/auth/token/revoke/", response_model=schemas.Message)
+async def revoke_token(
+    request: Request, response: Response, users: AsyncSession = Depends(Get_Users)
+):
+    presented = request.cookies.get(refresh_tokens.COOKIE)
+    if presented:
+        await refresh_tokens.revoke(users, presented)
+    clear_session_cookies(response)
+    return {"message": "Logged out"}
+
 
+# Hit/miss counters of the user cache behind token verification
+@app.get("/auth/cache/", response_model=schemas.UserCacheStats)
+def user_cache_stats():
+    return auth.user_cache.stats()
 
-@app.get("/whoami/")
+
+# Count, mean and max milliseconds per login step since startup
+@app.get("/auth/login/timings/", response_model=dict[str, schemas.StepTiming])
+def login_timing_stats():
+    return auth.login_timings.stats()
+
+
+@app.get("/whoami/", response_model=schemas.Username)
 async def whoami(request: Request, users: AsyncSession = Depends(Get_Users)):
     try:
         user = await auth.get_current_user(request.cookies.get("token"), users=users)
-        return {"username": user.username}
+        return schemas.Username(username=user.username)
     except HTTPException:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
 
 
-@app.get("/whitelist/")
-async def whitelist_root(whitelist: AsyncSession = Depends(Get_Whitelist)):
-    results = temp.ip_whitelist
-    return {"Here's a list of whitelisted IPs:": results}
+@app.get("/whitelist/", response_model=schemas.WhitelistOut)
+async def whitelist_root():
+    results = ip_whitelist.entries()
+    return schemas.WhitelistOut(ips=results)
+
+
+# Takes a single address or a CIDR block such as 192.168.1.0/24
+@app.post("/whitelist/add/", response_model=schemas.Message)
+async def add_whitelist_entry(
+    request: Request,
+    ip: str,
+    whitelist: AsyncSession = Depends(Get_Whitelist),
+    users: AsyncSession = Depends(Get_Users),
+):
+    await auth.get_current_user(request.cookies.get("token"), users=users)
+    try:
+        network = parse_entry(ip)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"{ip} is not an IP address or CIDR block",
+        )
+    results = await whitelist.execute(
+        select(Whitelist_DB).where(Whitelist_DB.ip == str(network))
+    )
+    if not results.scalars().first():
+        await whitelist.execute(insert(Whitelist_DB).values(ip=str(network)))
+        await whitelist.commit()
+    ip_whitelist.add(network)
+    return {"message": f"{network} whitelisted"}
+
+
+@app.delete("/whitelist/remove/", response_model=schemas.Message)
+async def remove_whitelist_entry(
+    request: Request,
+    ip: str,
+    whitelist: AsyncSession = Depends(Get_Whitelist),
+    users: AsyncSession = Depends(Get_Users),
+):
+    await auth.get_current_user(request.cookies.get("token"), users=users)
+    try:
+        network = parse_entry(ip)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"{ip} is not an IP address or CIDR block",
+        )
+    results = await whitelist.execute(
+        delete(Whitelist_DB).where(Whitelist_DB.ip == str(network))
+    )
+    await whitelist.commit()
+    if not results.rowcount:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail=f"{network} is not whitelisted"
+        )
+    ip_whitelist.remove(network)
+    return {"message": f"{network} removed from the whitelist"}
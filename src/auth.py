@@ -1,4 +1,7 @@
-from typing import Optional, Annotated
+from typing import Iterator, Optional, Annotated
+
+from contextlib import contextmanager
+import time
 
 from datetime import datetime, timedelta, timezone
 
@@ -16,6 +19,7 @@ from pydantic import BaseModel, EmailStr
 
 from pyotp import TOTP
 import pyotp
+import passwords
 from databaseinit import Get_Users
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
@@ -24,13 +28,19 @@ from db_models.user_models import User_DB
 
 import jwt
 from jwt.exceptions import InvalidTokenError
-from passlib.context import CryptContext
+from cachetools import TTLCache
 
 from dotenv import load_dotenv
 import os
 
 load_dotenv(dotenv_path="../.env")
 SUPER_SECRET_KEY = os.getenv("SUPER_SECRET_KEY")
+# Minutes an access token is valid, the frontend renews it with its refresh token
+ACCESS_TOKEN_MINUTES = float(os.getenv("ACCESS_TOKEN_MINUTES", "15"))
+# Users looked up by token verification are kept this many seconds, changes made by
+# other workers can take this long to show
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "1024"))
 
 
 class ErrorCode(Enum):
@@ -56,7 +66,6 @@ class Login(BaseModel):
 
 
 class Login_Response(BaseModel):
-    token: Optional[str] = None
     status: ErrorCode
 
 
@@ -69,70 +78,177 @@ class TokenData(BaseModel):
     username: Optional[str] = None
 
 
-basic_security = HTTPBasic()
-bearer_security = HTTPBearer()
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Users by username for get_current_user, anything that writes a user must invalidate it
+class UserCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self._users = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
 
+    def get(self, username: str) -> Optional[User]:
+        user = self._users.get(username)
+        if user is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return user
 
-def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+    def put(self, user: User):
+        self._users[user.username] = user
 
+    def invalidate(self, username: str):
+        self._users.pop(username, None)
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": self._users.currsize,
+            "maxsize": self._users.maxsize,
+            "ttl": self._users.ttl,
+        }
 
 
-# Data is JWT code and username, default expiration is 15 minutes
-async def create_jwt(
-    data: dict, users: AsyncSession, expires_delta: Optional[timedelta] = None
-) -> str:
-    to_encode = data.copy()
-    result = await users.execute(
-        select(User_DB).filter(User_DB.username == data["sub"])
-    )
-    user = result.scalars().first()
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+
+# Seconds one login request spent per step: db, bcrypt, totp, jwt and ticket (the login
+# ticket store). Sent back in a Server-Timing header and added to login_timings.
+class LoginTimings:
+    def __init__(self):
+        self.steps: dict[str, float] = {}
+
+    @contextmanager
+    def step(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps[name] = self.steps.get(name, 0.0) + time.perf_counter() - start
+
+    def header(self) -> str:
+        return ", ".join(
+            f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.steps.items()
+        )
+
+
+# Per step totals of every login request since startup, served at /auth/login/timings/
+class LoginTimingStats:
+    def __init__(self):
+        self.count: dict[str, int] = {}
+        self.total: dict[str, float] = {}
+        self.max: dict[str, float] = {}
+
+    def add(self, timings: LoginTimings):
+        for name, seconds in timings.steps.items():
+            self.count[name] = self.count.get(name, 0) + 1
+            self.total[name] = self.total.get(name, 0.0) + seconds
+            self.max[name] = max(self.max.get(name, 0.0), seconds)
+
+    def stats(self) -> dict:
+        return {
+            name: {
+                "count": count,
+                "mean_ms": self.total[name] / count * 1000,
+                "max_ms": self.max[name] * 1000,
+            }
+            for name, count in self.count.items()
+        }
 
-    if not user:
-        raise HTTPException(status_code=400, detail="User not found")
+
+login_timings = LoginTimingStats()
+
+basic_security = HTTPBasic()
+bearer_security = HTTPBearer()
+
+
+# bcrypt runs on the passwords process pool, which raises a 503 while it is saturated
+async def hash_password(password: str) -> str:
+    return await passwords.pool.hash(password)
+
+
+# Data is JWT code and username, default expiration is ACCESS_TOKEN_MINUTES
+# The caller has already loaded the user, this only signs
+def create_jwt(data: dict, expires_delta: Optional[timedelta] = None) -> str:
+    to_encode = data.copy()
     if expires_delta:
         expire = datetime.now(timezone.utc) + expires_delta
     else:
-        expire = datetime.now(timezone.utc) + timedelta(minutes=15)
+        expire = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_MINUTES)
     to_encode.update({"exp": expire})
     encoded_jwt = jwt.encode(to_encode, SUPER_SECRET_KEY, algorithm="HS256")
     return encoded_jwt
 
 
+def user_of(found: User_DB) -> User:
+    return User(
+        username=found.username,
+        email=found.email,
+        full_name=found.full_name,
+        disabled=found.disabled,
+        hashed_password=found.hashed_password,
+        secret_key=found.secret_key,
+        otp_enabled=found.otp_enabled,
+    )
+
+
+# The user behind a username, from user_cache when it was looked up recently
+async def load_user(username: str, users: AsyncSession) -> Optional[User]:
+    user = user_cache.get(username)
+    if user is None:
+        result = await users.execute(
+            select(User_DB).filter(User_DB.username == username)
+        )
+        found = result.scalars().first()
+        if not found:
+            return None
+        user = user_of(found)
+        user_cache.put(user)
+    return user
+
+
+# Password step of a login. Reads the user from the database (not the cache, the hash
+# must be current) and leaves it in the cache for the steps that follow.
 async def get_login(
     credentials: Annotated[HTTPBasicCredentials, Depends(basic_security)],
     users: AsyncSession,
+    timings: Optional[LoginTimings] = None,
 ) -> Login:
+    timings = timings or LoginTimings()
     resolution = Login(status=ErrorCode.INVALID_CREDENTIALS)
-    result = await users.execute(
-        select(User_DB).filter(User_DB.username == credentials.username)
-    )
-    user = result.scalars().first()
+    with timings.step("db"):
+        result = await users.execute(
+            select(User_DB).filter(User_DB.username == credentials.username)
+        )
+        found = result.scalars().first()
 
-    if not user:
+    if not found:
         # Simulate verifying a password
-        pwd_context.dummy_verify()
+        with timings.step("bcrypt"):
+            await passwords.pool.dummy_verify()
         raise HTTPException(status_code=400, detail="Invalid username or password")
-    if user.disabled:
+    if found.disabled:
         raise HTTPException(status_code=400, detail="User is disabled")
-    if verify_password(credentials.password, user.hashed_password):
-        resolution.user = User(
-            username=user.username,
-            email=user.email,
-            full_name=user.full_name,
-            disabled=user.disabled,
-            hashed_password=user.hashed_password,
-            secret_key=user.secret_key,
-            otp_enabled=user.otp_enabled,
+    with timings.step("bcrypt"):
+        verified, new_hash = await passwords.pool.verify_and_update(
+            credentials.password, found.hashed_password
         )
-        if resolution.user.otp_enabled:
-            resolution.status = ErrorCode.OTP_REQUIRED
-        else:
-            resolution.status = ErrorCode.SUCCESS
+    if not verified:
+        return resolution
+    if new_hash:
+        # Stored with an outdated cost factor, the new hash was made in the pool too
+        found.hashed_password = new_hash
+    # Copied before committing, which expires the row's attributes
+    user = user_of(found)
+    if new_hash:
+        with timings.step("db"):
+            await users.commit()
+    user_cache.put(user)
+    resolution.user = user
+    if user.otp_enabled:
+        resolution.status = ErrorCode.OTP_REQUIRED
+    else:
+        resolution.status = ErrorCode.SUCCESS
     return resolution
 
 
@@ -154,13 +270,14 @@ async def register_user(
     users.add(
         User_DB(
             username=credentials.username,
-            hashed_password=hash_password(credentials.password),
+            hashed_password=await hash_password(credentials.password),
             secret_key=secret_key,
             otp_enabled=False,
             disabled=False,
         )
     )
     await users.commit()
+    user_cache.invalidate(credentials.username)
     return {"message": f"User {credentials.username} registered successfully."}
 
 
@@ -177,62 +294,39 @@ async def get_current_user(
         username: str = payload.get("sub")
         if not username:
             raise credential_exception
-
-        result = await users.execute(
-            select(User_DB).filter(User_DB.username == username)
-        )
-        user = result.scalars().first()
-
-        if not user:
-            raise credential_exception
-        if user.disabled:
-            raise credential_exception
     except InvalidTokenError:
         raise credential_exception
 
-    return User(
-        username=user.username,
-        email=user.email,
-        full_name=user.full_name,
-        disabled=user.disabled,
-        hashed_password=user.hashed_password,
-        secret_key=user.secret_key,
-        otp_enabled=user.otp_enabled,
-    )
+    user = await load_user(username, users)
+    if user is None or user.disabled:
+        raise credential_exception
+    return user
 
 
 # OTP Stuff:
 
 
 async def check_otp(otp: Optional[str], secret_key: str):
-    previous_otp = TOTP(secret_key).at(datetime.now() - timedelta(seconds=30))
-    return TOTP(secret_key).verify(otp) or (otp == previous_otp)
+    totp = TOTP(secret_key)
+    previous_otp = totp.at(datetime.now() - timedelta(seconds=30))
+    return totp.verify(otp) or (otp == previous_otp)
 
 
+# Second step of a login whose password was already checked, by get_login or earlier
+# in the same login ticket. Takes the user loaded for that, nothing is queried here. The
+# session token is only signed by /auth/login/token/, once the login is complete.
 async def get_login_response(
-    login: Annotated[Login, Depends(get_login)],
-    users: AsyncSession,
+    user: User,
     otp: Optional[str] = None,
+    timings: Optional[LoginTimings] = None,
 ) -> Login_Response:
-    resolution = Login_Response(status=login.status)
-
-    result = await users.execute(
-        select(User_DB).filter(User_DB.username == login.user.username)
-    )
-    user = result.scalars().first()
-
-    if not user:
-        raise HTTPException(status_code=400, detail="User does not exist")
+    timings = timings or LoginTimings()
+    resolution = Login_Response(status=ErrorCode.SUCCESS)
 
     if user.otp_enabled:
-        resolution.status = ErrorCode.OTP_REQUIRED
-        if otp and await check_otp(otp, user.secret_key):
-            resolution.status = ErrorCode.SUCCESS
-            resolution.token = await create_jwt({"sub": user.username}, users=users)
-        else:
+        with timings.step("totp"):
+            verified = bool(otp) and await check_otp(otp, user.secret_key)
+        if not verified:
             print(TOTP(user.secret_key).now())
             resolution.status = ErrorCode.INVALID_OTP
-    else:
-        resolution.status = ErrorCode.SUCCESS
-        resolution.token = await create_jwt({"sub": user.username}, users=users)
     return resolution
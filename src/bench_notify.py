@@ -0,0 +1,97 @@
+# Load test for /notify/. Point the backend at a fake Calendar first, e.g.
+#   CALENDAR_SINK=http uvicorn api:app --port 8000
+#   uvicorn fake_calendar:app --port 8089
+#   python bench_notify.py --url http://127.0.0.1:8000 --requests 2000 --concurrency 50
+
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+from dotenv import load_dotenv
+import os
+
+load_dotenv(dotenv_path="../.env")
+BACKEND_URL = os.getenv("BACKEND_URL", "http://127.0.0.1:8000")
+
+
+def percentile(samples: list[float], fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+async def worker(
+    client: httpx.AsyncClient, jobs: asyncio.Queue, latencies: list, errors: list
+):
+    while True:
+        try:
+            number = jobs.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+        start = time.perf_counter()
+        try:
+            response = await client.post(
+                "/notify/", params={"message": f"bench {number}"}
+            )
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+        except httpx.HTTPError as error:
+            errors.append(error)
+
+
+async def wait_for_drain(client: httpx.AsyncClient, timeout: float) -> dict:
+    deadline = time.perf_counter() + timeout
+    while True:
+        counts = (await client.get("/notify/outbox/")).json()
+        if not counts["pending"] and not counts["in_flight"]:
+            return counts
+        if time.perf_counter() > deadline:
+            return counts
+        await asyncio.sleep(0.5)
+
+
+async def main(args):
+    jobs = asyncio.Queue()
+    for number in range(args.requests):
+        jobs.put_nowait(number)
+    latencies: list[float] = []
+    errors: list[Exception] = []
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(
+        base_url=args.url, limits=limits, timeout=60
+    ) as client:
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(worker(client, jobs, latencies, errors) for _ in range(args.concurrency))
+        )
+        elapsed = time.perf_counter() - start
+        print(f"{len(latencies)} ok, {len(errors)} errors in {elapsed:.2f}s")
+        print(f"throughput: {len(latencies) / elapsed:.1f} req/s")
+        if latencies:
+            print(
+                "latency ms: "
+                f"mean {statistics.mean(latencies) * 1000:.1f}, "
+                f"p50 {percentile(latencies, 0.50) * 1000:.1f}, "
+                f"p95 {percentile(latencies, 0.95) * 1000:.1f}, "
+                f"p99 {percentile(latencies, 0.99) * 1000:.1f}, "
+                f"max {max(latencies) * 1000:.1f}"
+            )
+        if args.drain_timeout > 0:
+            counts = await wait_for_drain(client, args.drain_timeout)
+            print(f"outbox after {time.perf_counter() - start:.2f}s: {counts}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test POST /notify/")
+    parser.add_argument("--url", default=BACKEND_URL)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument(
+        "--drain-timeout",
+        type=float,
+        default=120,
+        help="Seconds to wait for the outbox to empty afterwards, 0 to skip",
+    )
+    asyncio.run(main(parser.parse_args()))
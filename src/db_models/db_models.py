@@ -1,3 +1,4 @@
+from sqlalchemy import UniqueConstraint
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 
 
@@ -8,7 +9,7 @@ class DB_Base(DeclarativeBase):
 class Event(DB_Base):
     __tablename__ = "events"
     timestamp: Mapped[str] = mapped_column(nullable=False)
-    raw_timestamp: Mapped[float] = mapped_column(nullable=False)
+    raw_timestamp: Mapped[float] = mapped_column(nullable=False, index=True)
     description: Mapped[str]
     rowid: Mapped[int] = mapped_column(primary_key=True)
 
@@ -18,3 +19,52 @@ class Todo(DB_Base):
     description: Mapped[str] = mapped_column(nullable=False)
     bRepeats: Mapped[bool] = mapped_column(nullable=False)
     rowid: Mapped[int] = mapped_column(primary_key=True)
+
+
+# Calendar notifications waiting to be sent, written in the same transaction as their Event
+class Outbox(DB_Base):
+    __tablename__ = "outbox"
+    event_rowid: Mapped[int] = mapped_column(nullable=True)
+    # JSON encoded list of todo descriptions
+    todo_list: Mapped[str] = mapped_column(nullable=False)
+    status: Mapped[str] = mapped_column(nullable=False, index=True)
+    attempts: Mapped[int] = mapped_column(nullable=False, default=0)
+    next_attempt_at: Mapped[float] = mapped_column(nullable=False)
+    claimed_at: Mapped[float] = mapped_column(nullable=True)
+    created_at: Mapped[float] = mapped_column(nullable=False)
+    link: Mapped[str] = mapped_column(nullable=True)
+    last_error: Mapped[str] = mapped_column(nullable=True)
+    rowid: Mapped[int] = mapped_column(primary_key=True)
+
+
+# Hourly summary of Event rows removed by the retention job
+class EventRollup(DB_Base):
+    __tablename__ = "event_rollups"
+    # Start of the hour, epoch seconds
+    hour: Mapped[float] = mapped_column(nullable=False, unique=True)
+    count: Mapped[int] = mapped_column(nullable=False)
+    first_raw_timestamp: Mapped[float] = mapped_column(nullable=False)
+    last_raw_timestamp: Mapped[float] = mapped_column(nullable=False)
+    rowid: Mapped[int] = mapped_column(primary_key=True)
+
+
+# Events per time bucket and description, kept up to date as events are added and removed
+class EventCount(DB_Base):
+    __tablename__ = "event_counts"
+    __table_args__ = (UniqueConstraint("granularity", "bucket", "description"),)
+    # minute, hour or day
+    granularity: Mapped[str] = mapped_column(nullable=False)
+    # Start of the bucket, epoch seconds
+    bucket: Mapped[float] = mapped_column(nullable=False)
+    description: Mapped[str] = mapped_column(nullable=False)
+    count: Mapped[int] = mapped_column(nullable=False)
+    rowid: Mapped[int] = mapped_column(primary_key=True)
+
+
+# Bumped in the same transaction as every change to a table, so each process can tell
+# whether what it has cached is still current
+class TableVersion(DB_Base):
+    __tablename__ = "table_versions"
+    name: Mapped[str] = mapped_column(nullable=False, unique=True)
+    version: Mapped[int] = mapped_column(nullable=False)
+    rowid: Mapped[int] = mapped_column(primary_key=True)
@@ -15,3 +15,29 @@ class User_DB(User_Base):
     secret_key: Mapped[str] = mapped_column(nullable=False)
     otp_enabled: Mapped[bool] = mapped_column(nullable=False)
     rowid: Mapped[int] = mapped_column(primary_key=True)
+
+
+# Logins waiting for their OTP or token step, keyed by a hash of the login ticket
+class PendingLogin(User_Base):
+    __tablename__ = "pending_logins"
+    ticket: Mapped[str] = mapped_column(nullable=False, unique=True)
+    username: Mapped[str] = mapped_column(nullable=False)
+    status: Mapped[int] = mapped_column(nullable=False)
+    origin: Mapped[str] = mapped_column(nullable=True)
+    expires_at: Mapped[float] = mapped_column(nullable=False, index=True)
+    rowid: Mapped[int] = mapped_column(primary_key=True)
+
+
+# Refresh tokens, stored as hashes. Each refresh replaces the token with a new one of
+# the same family, the used one is kept until it expires to notice it being replayed.
+class RefreshToken(User_Base):
+    __tablename__ = "refresh_tokens"
+    token: Mapped[str] = mapped_column(nullable=False, unique=True)
+    username: Mapped[str] = mapped_column(nullable=False, index=True)
+    family: Mapped[str] = mapped_column(nullable=False, index=True)
+    used: Mapped[bool] = mapped_column(nullable=False)
+    used_at: Mapped[float] = mapped_column(nullable=True)
+    # The token that replaced this one, see refresh_tokens.seal()
+    successor: Mapped[str] = mapped_column(nullable=True)
+    expires_at: Mapped[float] = mapped_column(nullable=False, index=True)
+    rowid: Mapped[int] = mapped_column(primary_key=True)
@@ -0,0 +1,175 @@
+from typing import Optional
+
+from pydantic import BaseModel
+from sqlalchemy import (
+    AsyncAdaptedQueuePool,
+    Connection,
+    Engine,
+    QueuePool,
+    create_engine,
+    event,
+    make_url,
+    text,
+)
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+from dotenv import load_dotenv
+import os
+
+load_dotenv(dotenv_path="../.env")
+# Named SQLite tuning profile for every engine, each engine can override it
+DB_PROFILE = os.getenv("DB_PROFILE", "balanced")
+USERS_DB_PROFILE = os.getenv("USERS_DB_PROFILE", DB_PROFILE)
+WHITELIST_DB_PROFILE = os.getenv("WHITELIST_DB_PROFILE", DB_PROFILE)
+# Pool settings for database servers such as PostgreSQL, SQLite takes them from its profile
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+
+class SQLiteProfile(BaseModel):
+    name: str
+    journal_mode: str
+    synchronous: str
+    # Bytes of the file to memory map, 0 turns it off
+    mmap_size: int
+    # Negative values are KiB, positive values are pages
+    cache_size: int
+    # Milliseconds a connection waits on a lock before "database is locked"
+    busy_timeout: int
+    temp_store: str
+    pool_size: int
+    max_overflow: int
+
+
+PROFILES = {
+    # SQLite's own defaults, what the engines ran with before profiles existed
+    "compat": SQLiteProfile(
+        name="compat",
+        journal_mode="DELETE",
+        synchronous="FULL",
+        mmap_size=0,
+        cache_size=-2000,
+        busy_timeout=5000,
+        temp_store="DEFAULT",
+        pool_size=5,
+        max_overflow=10,
+    ),
+    # WAL lets readers run next to the writer, NORMAL only risks the last commits on power loss
+    "balanced": SQLiteProfile(
+        name="balanced",
+        journal_mode="WAL",
+        synchronous="NORMAL",
+        mmap_size=256 * 1024 * 1024,
+        cache_size=-64000,
+        busy_timeout=5000,
+        temp_store="MEMORY",
+        pool_size=5,
+        max_overflow=10,
+    ),
+    # Same as balanced but fsyncs every commit
+    "durable": SQLiteProfile(
+        name="durable",
+        journal_mode="WAL",
+        synchronous="FULL",
+        mmap_size=256 * 1024 * 1024,
+        cache_size=-64000,
+        busy_timeout=10000,
+        temp_store="MEMORY",
+        pool_size=5,
+        max_overflow=10,
+    ),
+    # Bigger caches and pool for many concurrent devices and pollers
+    "throughput": SQLiteProfile(
+        name="throughput",
+        journal_mode="WAL",
+        synchronous="NORMAL",
+        mmap_size=1024 * 1024 * 1024,
+        cache_size=-256000,
+        busy_timeout=15000,
+        temp_store="MEMORY",
+        pool_size=20,
+        max_overflow=20,
+    ),
+}
+
+
+def get_profile(name: str) -> SQLiteProfile:
+    if name not in PROFILES:
+        raise ValueError(
+            f"Unknown SQLite profile {name!r}, pick one of {list(PROFILES)}"
+        )
+    return PROFILES[name]
+
+
+# Pool settings for create_engine/create_async_engine, the SQLite dialects would
+# otherwise pick a pool that cannot be sized
+def engine_options(profile: SQLiteProfile, is_async: bool = True) -> dict:
+    return {
+        "poolclass": AsyncAdaptedQueuePool if is_async else QueuePool,
+        "pool_size": profile.pool_size,
+        "max_overflow": profile.max_overflow,
+    }
+
+
+# Applies the profile's pragmas to every new connection of a sync or async engine
+def apply_profile(engine: Engine, profile: SQLiteProfile):
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # Only takes on a new file, and only before journal_mode, so retention can hand
+        # freed pages back without a full VACUUM. Existing files keep their mode.
+        cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        cursor.execute(f"PRAGMA journal_mode={profile.journal_mode}")
+        cursor.execute(f"PRAGMA synchronous={profile.synchronous}")
+        cursor.execute(f"PRAGMA mmap_size={profile.mmap_size}")
+        cursor.execute(f"PRAGMA cache_size={profile.cache_size}")
+        cursor.execute(f"PRAGMA busy_timeout={profile.busy_timeout}")
+        cursor.execute(f"PRAGMA temp_store={profile.temp_store}")
+        cursor.close()
+
+
+def is_sqlite(url: str) -> bool:
+    return make_url(url).get_backend_name() == "sqlite"
+
+
+# Creates the engine for a database URL. SQLite URLs get the named profile, anything
+# else (e.g. postgresql+asyncpg://) gets a regular server connection pool.
+def make_engine(
+    url: str, profile_name: str, is_async: bool = True
+) -> tuple[Engine | AsyncEngine, Optional[SQLiteProfile]]:
+    create = create_async_engine if is_async else create_engine
+    if not is_sqlite(url):
+        engine = create(
+            url,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE,
+            pool_pre_ping=True,
+        )
+        return engine, None
+    profile = get_profile(profile_name)
+    engine = create(
+        url,
+        connect_args={"check_same_thread": False},
+        **engine_options(profile, is_async),
+    )
+    apply_profile(engine.sync_engine if is_async else engine, profile)
+    return engine, profile
+
+
+# What the connection actually runs with, for the startup log line
+def describe(conn: Connection, profile: Optional[SQLiteProfile]) -> str:
+    if profile is None:
+        return (
+            f"{conn.dialect.name} {conn.dialect.server_version_info}, "
+            f"pool {DB_POOL_SIZE}+{DB_MAX_OVERFLOW}"
+        )
+    pragmas = ["journal_mode", "synchronous", "mmap_size", "cache_size", "busy_timeout"]
+    values = ", ".join(
+        f"{pragma}={conn.execute(text(f'PRAGMA {pragma}')).scalar()}"
+        for pragma in pragmas
+    )
+    return f"profile {profile.name} ({values}, pool {profile.pool_size}+{profile.max_overflow})"
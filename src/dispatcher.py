@@ -0,0 +1,51 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import NotifyCalendar as NotifyCalendar
+
+from dotenv import load_dotenv
+import os
+
+load_dotenv(dotenv_path="../.env")
+# Max number of Calendar calls running at once
+NOTIFY_MAX_WORKERS = int(os.getenv("NOTIFY_MAX_WORKERS", "4"))
+# Seconds a single Calendar call may take before it is reported as timed out
+NOTIFY_TIMEOUT = float(os.getenv("NOTIFY_TIMEOUT", "30"))
+
+
+# Runs the blocking NotifyCalendar calls on a bounded thread pool so the event loop
+# never waits on Google. A worker slot is only handed back once its thread is
+# actually done, so a call that timed out still counts against the limit until it
+# returns.
+class Dispatcher:
+    def __init__(self, max_workers: int, timeout: float):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="calendar"
+        )
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    # Returns the event link, raises asyncio.TimeoutError or whatever the Calendar call raised
+    async def run(self, todo_list: list[str]) -> str:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_workers)
+        loop = asyncio.get_running_loop()
+        await self._slots.acquire()
+        future = self._executor.submit(NotifyCalendar.notify, todo_list)
+        future.add_done_callback(
+            lambda _: loop.call_soon_threadsafe(self._slots.release)
+        )
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout=self.timeout)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Keeps the first occurrence of every item, in order
+def merge_todo_lists(todo_lists: list[list[str]]) -> list[str]:
+    return list(dict.fromkeys(item for todo_list in todo_lists for item in todo_list))
+
+
+dispatcher = Dispatcher(NOTIFY_MAX_WORKERS, NOTIFY_TIMEOUT)
@@ -0,0 +1,74 @@
+import csv
+import io
+from typing import AsyncIterator, Callable
+
+import orjson
+from sqlalchemy import Select, select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from db_models.db_models import Event
+
+from dotenv import load_dotenv
+import os
+
+load_dotenv(dotenv_path="../.env")
+# Default and largest number of rows fetched and sent per chunk by /events/export
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "1000"))
+MAX_EXPORT_CHUNK_SIZE = int(os.getenv("MAX_EXPORT_CHUNK_SIZE", "10000"))
+
+COLUMNS = ["rowid", "timestamp", "raw_timestamp", "description"]
+
+
+def event_query(since: float | None, until: float | None) -> Select:
+    query = select(Event).order_by(Event.rowid)
+    if since is not None:
+        query = query.where(Event.raw_timestamp >= since)
+    if until is not None:
+        query = query.where(Event.raw_timestamp < until)
+    return query
+
+
+def ndjson_chunk(events: list[Event]) -> bytes:
+    return b"".join(
+        orjson.dumps({column: getattr(event, column) for column in COLUMNS}) + b"\n"
+        for event in events
+    )
+
+
+def csv_chunk(events: list[Event]) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerows([getattr(event, column) for column in COLUMNS] for event in events)
+    return buffer.getvalue().encode()
+
+
+def csv_header() -> bytes:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(COLUMNS)
+    return buffer.getvalue().encode()
+
+
+# format -> (media type, header, chunk serializer)
+FORMATS: dict[str, tuple[str, bytes, Callable[[list[Event]], bytes]]] = {
+    "ndjson": ("application/x-ndjson", b"", ndjson_chunk),
+    "csv": ("text/csv", csv_header(), csv_chunk),
+}
+
+
+# Streams the events chunk by chunk from a server-side cursor, so only chunk_size rows
+# are in memory at once. The session is opened here rather than taken from Get_Shard_DB,
+# because a dependency is closed before the response body has been sent.
+async def stream_events(
+    session_factory: async_sessionmaker,
+    query: Select,
+    format: str,
+    chunk_size: int,
+) -> AsyncIterator[bytes]:
+    _, header, serialize = FORMATS[format]
+    if header:
+        yield header
+    async with session_factory() as db:
+        results = await db.stream_scalars(query.execution_options(yield_per=chunk_size))
+        async for events in results.partitions():
+            # The identity map only holds weak references, so sent rows are freed
+            yield serialize(events)
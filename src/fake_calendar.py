@@ -0,0 +1,62 @@
+# Local stand-in for the Google Calendar events().insert endpoint, used with
+# CALENDAR_SINK=http to load test /notify/ offline:
+#   uvicorn fake_calendar:app --port 8089
+
+import asyncio
+import itertools
+import random
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+from dotenv import load_dotenv
+import os
+
+load_dotenv(dotenv_path="../.env")
+# Mean latency of an insert and how far it may stray either way
+FAKE_CALENDAR_LATENCY_MS = float(os.getenv("FAKE_CALENDAR_LATENCY_MS", "150"))
+FAKE_CALENDAR_JITTER_MS = float(os.getenv("FAKE_CALENDAR_JITTER_MS", "50"))
+# Fraction of inserts answered with a 503 like an overloaded Google backend
+FAKE_CALENDAR_ERROR_RATE = float(os.getenv("FAKE_CALENDAR_ERROR_RATE", "0"))
+
+app = FastAPI()
+
+ids = itertools.count(1)
+stats = {"inserted": 0, "failed": 0}
+
+
+@app.post("/calendar/v3/calendars/{calendarId}/events")
+async def insert_event(calendarId: str, request: Request):
+    event = await request.json()
+    delay = FAKE_CALENDAR_LATENCY_MS + random.uniform(
+        -FAKE_CALENDAR_JITTER_MS, FAKE_CALENDAR_JITTER_MS
+    )
+    await asyncio.sleep(max(delay, 0) / 1000)
+    if random.random() < FAKE_CALENDAR_ERROR_RATE:
+        stats["failed"] += 1
+        return JSONResponse(
+            status_code=503,
+            content={
+                "error": {
+                    "code": 503,
+                    "message": "The service is currently unavailable.",
+                    "errors": [{"reason": "backendError"}],
+                }
+            },
+        )
+    stats["inserted"] += 1
+    event_id = str(next(ids))
+    return {
+        **event,
+        "kind": "calendar#event",
+        "id": event_id,
+        "status": "confirmed",
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "htmlLink": f"http://{request.url.netloc}/calendar/event?eid={event_id}",
+    }
+
+
+@app.get("/stats")
+async def get_stats():
+    return stats
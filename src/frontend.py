@@ -15,12 +15,13 @@ FRONTEND_PORT = os.getenv("FRONTEND_PORT")
 STORAGE_SECRET = os.getenv("STORAGE_SECRET")
 
 
+# An expired access token is renewed with the refresh token cookie and the call retried
+# once. Concurrent calls share one refresh, a refresh token only works once.
 async def call_api(url: str, method: str = "GET"):
     response = await ui.run_javascript(
         f"""
-            async function fetchData() {{
-            try {{
-                const response = await fetch("{BACKEND_URL}{url}",
+            function request() {{
+                return fetch("{BACKEND_URL}{url}",
                 {{credentials: "include",
                 headers: {{
                         "Accept": "application/json",
@@ -28,6 +29,23 @@ async def call_api(url: str, method: str = "GET"):
                     }},
                     method: "{method}"
                     }});
+            }}
+            function refresh() {{
+                if (!window.tokenRefresh) {{
+                    window.tokenRefresh = fetch("{BACKEND_URL}/auth/token/refresh/",
+                        {{credentials: "include", method: "POST"}})
+                        .then((response) => response.ok, () => false)
+                        .finally(() => {{ window.tokenRefresh = null; }});
+                }}
+                return window.tokenRefresh;
+            }}
+            async function fetchData() {{
+            try {{
+                let response = await request();
+                if (response.status === 401 && !"{url}".startsWith("/auth/login")
+                    && await refresh()) {{
+                    response = await request();
+                }}
                 if (!response.ok) {{
                     return false;
                     }}
@@ -61,7 +79,8 @@ app.add_middleware(AuthMiddleware)
 
 @ui.page("/")
 async def main_page():
-    def logout():
+    async def logout():
+        await call_api("/auth/token/revoke", method="POST")
         app.storage.user.clear()
         ui.navigate.to("/login")
 
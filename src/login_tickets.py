@@ -0,0 +1,162 @@
+# Logins in progress, between the password step and the OTP or token step. The browser
+# holds an opaque ticket in the login_ticket cookie and the server keeps what it stands
+# for, so concurrent logins no longer overwrite each other.
+
+import hashlib
+import secrets
+import time
+from typing import Optional
+
+from cachetools import TTLCache
+from pydantic import BaseModel
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from auth import ErrorCode
+from databaseinit import User_Session
+from db_models.user_models import PendingLogin as PendingLogin_DB
+import upserts
+
+from dotenv import load_dotenv
+import os
+
+load_dotenv(dotenv_path="../.env")
+# Where pending logins are kept, memory (this process only) or sql (the users database,
+# shared by every worker)
+LOGIN_TICKET_BACKEND = os.getenv("LOGIN_TICKET_BACKEND", "memory")
+# Seconds a login ticket stays valid
+LOGIN_TICKET_TTL = int(os.getenv("LOGIN_TICKET_TTL", "300"))
+# Max pending logins kept in memory, the least recently used one is dropped past this
+LOGIN_TICKET_MAX = int(os.getenv("LOGIN_TICKET_MAX", "10000"))
+
+COOKIE = "login_ticket"
+# Origin of the tickets the password step hands out
+PASSWORD = "password"
+
+
+# origin is the step that created the ticket, None for tickets kept from before it was
+# recorded
+class PendingLogin(BaseModel):
+    username: str
+    status: ErrorCode
+    origin: Optional[str] = None
+
+
+# Only a login that began with the password, and passed its OTP if it has one, is
+# traded for a token
+def finished(pending: PendingLogin) -> bool:
+    return pending.origin == PASSWORD and pending.status == ErrorCode.SUCCESS
+
+
+def new_ticket() -> str:
+    return secrets.token_urlsafe(32)
+
+
+class MemoryTickets:
+    def __init__(self, size: int, ttl: int):
+        self._pending: TTLCache[str, PendingLogin] = TTLCache(maxsize=size, ttl=ttl)
+
+    async def get(self, ticket: str) -> Optional[PendingLogin]:
+        return self._pending.get(ticket)
+
+    async def put(self, ticket: str, pending: PendingLogin):
+        self._pending[ticket] = pending
+
+    # Removes and returns the ticket if it is finished(), leaves it alone otherwise
+    async def pop_finished(self, ticket: str) -> Optional[PendingLogin]:
+        pending = self._pending.get(ticket)
+        if pending is None or not finished(pending):
+            return None
+        return self._pending.pop(ticket)
+
+
+# Only a hash of the ticket is stored, so reading the table does not give out logins
+class SqlTickets:
+    def __init__(self, session_factory: async_sessionmaker, ttl: int):
+        self.session_factory = session_factory
+        self.ttl = ttl
+
+    async def get(self, ticket: str) -> Optional[PendingLogin]:
+        async with self.session_factory() as users:
+            found = (
+                await users.execute(
+                    select(PendingLogin_DB).where(
+                        PendingLogin_DB.ticket == self._key(ticket),
+                        PendingLogin_DB.expires_at > time.time(),
+                    )
+                )
+            ).scalar()
+            if found is None:
+                return None
+            return PendingLogin(
+                username=found.username, status=found.status, origin=found.origin
+            )
+
+    async def put(self, ticket: str, pending: PendingLogin):
+        now = time.time()
+        async with self.session_factory() as users:
+            # Expired tickets are dropped as new ones come in
+            await users.execute(
+                delete(PendingLogin_DB).where(PendingLogin_DB.expires_at <= now)
+            )
+            await users.execute(
+                upserts.upsert(
+                    users,
+                    PendingLogin_DB,
+                    ["ticket"],
+                    lambda excluded: {
+                        "status": excluded.status,
+                        "expires_at": excluded.expires_at,
+                    },
+                ),
+                {
+                    "ticket": self._key(ticket),
+                    "username": pending.username,
+                    "status": pending.status.value,
+                    "origin": pending.origin,
+                    "expires_at": now + self.ttl,
+                },
+            )
+            await users.commit()
+
+    # One statement, so two token requests with the same ticket can't both get it
+    async def pop_finished(self, ticket: str) -> Optional[PendingLogin]:
+        async with self.session_factory() as users:
+            found = (
+                await users.execute(
+                    delete(PendingLogin_DB)
+                    .where(
+                        PendingLogin_DB.ticket == self._key(ticket),
+                        PendingLogin_DB.status == ErrorCode.SUCCESS.value,
+                        PendingLogin_DB.origin == PASSWORD,
+                        PendingLogin_DB.expires_at > time.time(),
+                    )
+                    .returning(
+                        PendingLogin_DB.username,
+                        PendingLogin_DB.status,
+                        PendingLogin_DB.origin,
+                    )
+                    .execution_options(synchronize_session=False)
+                )
+            ).first()
+            await users.commit()
+            if found is None:
+                return None
+            return PendingLogin(
+                username=found.username, status=found.status, origin=found.origin
+            )
+
+    @staticmethod
+    def _key(ticket: str) -> str:
+        return hashlib.sha256(ticket.encode()).hexdigest()
+
+
+def make_store(backend: str):
+    if backend == "memory":
+        return MemoryTickets(LOGIN_TICKET_MAX, LOGIN_TICKET_TTL)
+    if backend == "sql":
+        return SqlTickets(User_Session, LOGIN_TICKET_TTL)
+    raise ValueError(f"Unknown LOGIN_TICKET_BACKEND {backend}")
+
+
+tickets = make_store(LOGIN_TICKET_BACKEND)
@@ -0,0 +1,263 @@
+import ipaddress
+from typing import Callable
+
+from sqlalchemy import (
+    Boolean,
+    Column,
+    Connection,
+    Float,
+    Index,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    UniqueConstraint,
+    delete,
+    inspect,
+    insert,
+    select,
+    update,
+)
+from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.schema import CreateColumn
+
+# Every database file keeps the number of migrations applied to it in this table
+version_metadata = MetaData()
+schema_version = Table(
+    "schema_version",
+    version_metadata,
+    Column("version", Integer, nullable=False),
+)
+
+Migration = Callable[[Connection], None]
+
+
+# Creates tables as a migration defined them. Tables that already exist are skipped, so
+# files created before versioning was added are picked up as they are.
+def create_tables(*tables: Table) -> Migration:
+    def migration(conn: Connection):
+        for table in tables:
+            table.create(conn, checkfirst=True)
+
+    return migration
+
+
+def create_indexes(*indexes: Index) -> Migration:
+    def migration(conn: Connection):
+        for index in indexes:
+            index.create(conn, checkfirst=True)
+
+    return migration
+
+
+# Adds nullable columns to a table an earlier migration created, skipping those it
+# already has
+def add_columns(table: Table, *columns: Column) -> Migration:
+    def migration(conn: Connection):
+        existing = {column["name"] for column in inspect(conn).get_columns(table.name)}
+        for column in columns:
+            if column.name in existing:
+                continue
+            ddl = CreateColumn(column).compile(dialect=conn.dialect)
+            conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {ddl}")
+
+    return migration
+
+
+def Key() -> Column:
+    return Column("rowid", Integer, primary_key=True)
+
+
+# The tables below are the schema each migration created, written out instead of taken
+# from the models so that a version always means the same schema. Never edit them,
+# change a table with a new migration (and the model) instead.
+
+db_history = MetaData()
+events = Table(
+    "events",
+    db_history,
+    Column("timestamp", String, nullable=False),
+    Column("raw_timestamp", Float, nullable=False),
+    Column("description", String, nullable=False),
+    Key(),
+)
+todo = Table(
+    "todo",
+    db_history,
+    Column("description", String, nullable=False),
+    Column("bRepeats", Boolean, nullable=False),
+    Key(),
+)
+outbox = Table(
+    "outbox",
+    db_history,
+    Column("event_rowid", Integer, nullable=True),
+    Column("todo_list", String, nullable=False),
+    Column("status", String, nullable=False, index=True),
+    Column("attempts", Integer, nullable=False),
+    Column("next_attempt_at", Float, nullable=False),
+    Column("claimed_at", Float, nullable=True),
+    Column("created_at", Float, nullable=False),
+    Column("link", String, nullable=True),
+    Column("last_error", String, nullable=True),
+    Key(),
+)
+event_rollups = Table(
+    "event_rollups",
+    db_history,
+    Column("hour", Float, nullable=False, unique=True),
+    Column("count", Integer, nullable=False),
+    Column("first_raw_timestamp", Float, nullable=False),
+    Column("last_raw_timestamp", Float, nullable=False),
+    Key(),
+)
+event_counts = Table(
+    "event_counts",
+    db_history,
+    Column("granularity", String, nullable=False),
+    Column("bucket", Float, nullable=False),
+    Column("description", String, nullable=False),
+    Column("count", Integer, nullable=False),
+    Key(),
+    UniqueConstraint("granularity", "bucket", "description"),
+)
+table_versions = Table(
+    "table_versions",
+    db_history,
+    Column("name", String, nullable=False, unique=True),
+    Column("version", Integer, nullable=False),
+    Key(),
+)
+
+user_history = MetaData()
+users = Table(
+    "users",
+    user_history,
+    Column("username", String, nullable=False),
+    Column("email", String, nullable=True),
+    Column("full_name", String, nullable=True),
+    Column("disabled", Boolean, nullable=False),
+    Column("hashed_password", String, nullable=False),
+    Column("secret_key", String, nullable=False),
+    Column("otp_enabled", Boolean, nullable=False),
+    Key(),
+)
+pending_logins = Table(
+    "pending_logins",
+    user_history,
+    Column("ticket", String, nullable=False, unique=True),
+    Column("username", String, nullable=False),
+    Column("status", Integer, nullable=False),
+    Column("expires_at", Float, nullable=False, index=True),
+    Key(),
+)
+refresh_tokens = Table(
+    "refresh_tokens",
+    user_history,
+    Column("token", String, nullable=False, unique=True),
+    Column("username", String, nullable=False, index=True),
+    Column("family", String, nullable=False, index=True),
+    Column("used", Boolean, nullable=False),
+    Column("expires_at", Float, nullable=False, index=True),
+    Key(),
+)
+
+whitelist_history = MetaData()
+whitelist = Table(
+    "whitelist",
+    whitelist_history,
+    Column("ip", String, nullable=False),
+    Key(),
+)
+
+
+# Append new migrations at the end, never reorder or remove them. Migration n brings
+# a database from version n - 1 to version n. A new database skips them all, see
+# upgrade().
+DB_MIGRATIONS: list[Migration] = [
+    create_tables(events, todo, outbox),
+    # 2: time range filters on /events/
+    create_indexes(Index("ix_events_raw_timestamp", events.c.raw_timestamp)),
+    # 3: event_rollups for the retention job
+    create_tables(event_rollups),
+    # 4: event_counts for /events/stats, fill it with python stats.py --rebuild
+    create_tables(event_counts),
+    # 5: table_versions for the todo cache
+    create_tables(table_versions),
+]
+
+USER_MIGRATIONS: list[Migration] = [
+    create_tables(users),
+    # 2: pending_logins for the sql login ticket store
+    create_tables(pending_logins),
+    # 3: refresh_tokens
+    create_tables(refresh_tokens),
+    # 4: which login step created a ticket
+    add_columns(pending_logins, Column("origin", String, nullable=True)),
+    # 5: what replaced a refresh token and when, for the refresh grace period
+    add_columns(
+        refresh_tokens,
+        Column("used_at", Float, nullable=True),
+        Column("successor", String, nullable=True),
+    ),
+]
+
+
+# Entries used to be stored as typed, e.g. 1.2.3.4, while the endpoints now look them up
+# by their network, e.g. 1.2.3.4/32. Rewrites every entry to its network and drops the
+# duplicates that leaves. Invalid entries are kept, the whitelist skips them on load.
+def normalize_whitelist(conn: Connection):
+    seen = set()
+    rows = conn.execute(select(whitelist.c.rowid, whitelist.c.ip).order_by("rowid"))
+    for rowid, ip in rows.all():
+        try:
+            network = str(ipaddress.ip_network(ip.strip(), strict=False))
+        except ValueError:
+            continue
+        if network in seen:
+            conn.execute(delete(whitelist).where(whitelist.c.rowid == rowid))
+        elif network != ip:
+            conn.execute(
+                update(whitelist).where(whitelist.c.rowid == rowid).values(ip=network)
+            )
+        seen.add(network)
+
+
+WHITELIST_MIGRATIONS: list[Migration] = [
+    create_tables(whitelist),
+    # 2: entries stored as networks
+    normalize_whitelist,
+]
+
+
+def current_version(conn: Connection) -> int:
+    version_metadata.create_all(conn)
+    version = conn.execute(select(schema_version.c.version)).scalar()
+    if version is None:
+        conn.execute(insert(schema_version).values(version=0))
+        version = 0
+    return version
+
+
+# Runs the pending migrations in the caller's transaction, returns the new version. A
+# database without any tables yet is created from the models and marked up to date,
+# the models and the migrations must therefore always describe the same schema.
+def upgrade(
+    conn: Connection, migrations: list[Migration], base: type[DeclarativeBase]
+) -> int:
+    existing = set(inspect(conn).get_table_names())
+    if not existing & ({schema_version.name} | base.metadata.tables.keys()):
+        base.metadata.create_all(conn)
+        version_metadata.create_all(conn)
+        conn.execute(insert(schema_version).values(version=len(migrations)))
+        return len(migrations)
+    version = current_version(conn)
+    for migration in migrations[version:]:
+        migration(conn)
+        version += 1
+        conn.execute(update(schema_version).values(version=version))
+    return version
+
+
+def drop_version(conn: Connection):
+    version_metadata.drop_all(conn)
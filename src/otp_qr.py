@@ -0,0 +1,62 @@
+# QR codes of the OTP provisioning URI, rendered on a worker thread and kept per user.
+# Entries are keyed by a hash of the secret too, so a new secret never gets an old image.
+
+import asyncio
+import hashlib
+import io
+from collections import OrderedDict
+from typing import Literal
+
+import pyotp
+import qrcode
+import qrcode.image.svg
+
+from dotenv import load_dotenv
+import os
+
+load_dotenv(dotenv_path="../.env")
+# Max rendered QR codes kept, the least recently used one is dropped past this
+OTP_QR_CACHE_SIZE = int(os.getenv("OTP_QR_CACHE_SIZE", "256"))
+
+ISSUER = "An Embedded System Web App"
+
+Format = Literal["png", "svg"]
+MEDIA_TYPES = {"png": "image/png", "svg": "image/svg+xml"}
+
+
+def render(uri: str, format: Format) -> bytes:
+    if format == "svg":
+        image = qrcode.make(uri, image_factory=qrcode.image.svg.SvgPathImage)
+    else:
+        image = qrcode.make(uri)
+    buffer = io.BytesIO()
+    image.save(buffer)
+    return buffer.getvalue()
+
+
+# The ETag names the user, secret and format, so it is known before anything is rendered
+def etag(username: str, secret_key: str, format: Format) -> str:
+    digest = hashlib.sha256(f"{username}\0{secret_key}\0{format}".encode()).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+class QRCache:
+    def __init__(self, size: int):
+        self.size = size
+        self._images: OrderedDict[tuple[str, str], bytes] = OrderedDict()
+
+    async def get(self, username: str, secret_key: str, format: Format) -> bytes:
+        key = (username, etag(username, secret_key, format))
+        image = self._images.get(key)
+        if image is not None:
+            self._images.move_to_end(key)
+            return image
+        uri = pyotp.TOTP(secret_key).provisioning_uri(username, issuer_name=ISSUER)
+        image = await asyncio.to_thread(render, uri, format)
+        self._images[key] = image
+        while len(self._images) > self.size:
+            self._images.popitem(last=False)
+        return image
+
+
+qr_cache = QRCache(OTP_QR_CACHE_SIZE)
@@ -0,0 +1,230 @@
+import asyncio
+import json
+import time
+from enum import Enum
+from typing import Optional
+
+from sqlalchemy import and_, case, func, insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from databaseinit import DB_Session
+from db_models.db_models import Outbox
+from dispatcher import dispatcher, merge_todo_lists
+
+from dotenv import load_dotenv
+import os
+
+load_dotenv(dotenv_path="../.env")
+# Notifications arriving within this many seconds are merged into one Calendar event
+NOTIFY_COALESCE_WINDOW = float(os.getenv("NOTIFY_COALESCE_WINDOW", "2"))
+# Max outbox rows claimed (and merged into one event) per Calendar call
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+# Attempts before a row is marked failed for good
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+# Retry delay is OUTBOX_BACKOFF * 2 ** (attempts - 1), capped at OUTBOX_MAX_BACKOFF seconds
+OUTBOX_BACKOFF = float(os.getenv("OUTBOX_BACKOFF", "5"))
+OUTBOX_MAX_BACKOFF = float(os.getenv("OUTBOX_MAX_BACKOFF", "3600"))
+# Seconds before an in-flight row whose worker died (e.g. a restart) is retried, which
+# counts as an attempt
+OUTBOX_LEASE = float(os.getenv("OUTBOX_LEASE", "120"))
+# Seconds between outbox scans when no notification wakes the drainer
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "30"))
+
+
+class OutboxState(Enum):
+    PENDING = "pending"
+    IN_FLIGHT = "in_flight"
+    DONE = "done"
+    FAILED = "failed"
+
+
+# Adds a notification to the outbox, the caller commits it together with its Event
+async def enqueue(
+    db: AsyncSession, todo_list: list[str], event_rowid: Optional[int] = None
+) -> int:
+    now = time.time()
+    result = await db.execute(
+        insert(Outbox)
+        .values(
+            event_rowid=event_rowid,
+            todo_list=json.dumps(todo_list),
+            status=OutboxState.PENDING.value,
+            attempts=0,
+            next_attempt_at=now,
+            created_at=now,
+        )
+        .returning(Outbox.rowid)
+    )
+    return result.scalar_one()
+
+
+async def counts(db: AsyncSession) -> dict[str, int]:
+    results = await db.execute(
+        select(Outbox.status, func.count()).group_by(Outbox.status)
+    )
+    totals = {state.value: 0 for state in OutboxState}
+    totals.update({state: count for state, count in results.all()})
+    return totals
+
+
+def backoff(attempts: int) -> float:
+    return min(OUTBOX_BACKOFF * 2 ** (attempts - 1), OUTBOX_MAX_BACKOFF)
+
+
+# Background task that claims outbox rows in batches and sends each batch as one
+# Calendar event through the dispatcher. Claims are leases, so rows left in flight
+# by a crashed or restarted process are picked up again once the lease runs out.
+class OutboxDrainer:
+    def __init__(self, session_factory: async_sessionmaker):
+        self.session_factory = session_factory
+        self._wake = asyncio.Event()
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._tasks: set[asyncio.Task] = set()
+        self._claiming = False
+
+    def wake(self):
+        self._wake.set()
+
+    # A claim or delivery is under way, shutting down now would leave rows in flight
+    # until their lease runs out and cost them an attempt
+    @property
+    def busy(self) -> bool:
+        return self._claiming or bool(self._tasks)
+
+    async def run(self):
+        self._slots = asyncio.Semaphore(dispatcher.max_workers)
+        while True:
+            await self._slots.acquire()
+            self._claiming = True
+            try:
+                batch = await self._claim()
+            except Exception as error:
+                if asyncio.current_task().cancelling():
+                    raise
+                print(f"Outbox claim failed: {error}")
+                batch = []
+            finally:
+                self._claiming = False
+            if batch:
+                task = asyncio.create_task(self._deliver(batch))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+                continue
+            self._slots.release()
+            await self._wait_for_work()
+
+    async def shutdown(self, task: asyncio.Task):
+        task.cancel()
+        for delivery in self._tasks:
+            delivery.cancel()
+        await asyncio.gather(task, *self._tasks, return_exceptions=True)
+
+    async def _wait_for_work(self):
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout=OUTBOX_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            return
+        # Let the rest of a burst land so it shares the Calendar event
+        await asyncio.sleep(NOTIFY_COALESCE_WINDOW)
+        self._wake.clear()
+
+    async def _claim(self) -> list[tuple[int, str, int]]:
+        now = time.time()
+        claimable = and_(
+            Outbox.status == OutboxState.PENDING.value,
+            Outbox.next_attempt_at <= now,
+        )
+        oldest = (
+            select(Outbox.rowid)
+            .where(claimable)
+            .order_by(Outbox.rowid)
+            .limit(OUTBOX_BATCH_SIZE)
+        )
+        async with self.session_factory() as db:
+            await self._reclaim(db, now)
+            # claimable is repeated so a row another worker grabbed in the meantime is skipped
+            results = await db.execute(
+                update(Outbox)
+                .where(Outbox.rowid.in_(oldest.scalar_subquery()), claimable)
+                .values(status=OutboxState.IN_FLIGHT.value, claimed_at=now)
+                .returning(Outbox.rowid, Outbox.todo_list, Outbox.attempts)
+                # Fresh session, nothing to sync, and syncing scrambles the RETURNING columns
+                .execution_options(synchronize_session=False)
+            )
+            batch = results.all()
+            await db.commit()
+        return batch
+
+    # A lease that ran out means the worker sending the row died, which counts as a
+    # failed attempt. Otherwise a row that crashes its worker would be retried forever.
+    async def _reclaim(self, db: AsyncSession, now: float):
+        attempts = Outbox.attempts + 1
+        await db.execute(
+            update(Outbox)
+            .where(
+                Outbox.status == OutboxState.IN_FLIGHT.value,
+                Outbox.claimed_at < now - OUTBOX_LEASE,
+            )
+            .values(
+                attempts=attempts,
+                last_error="Lease expired before the Calendar call finished",
+                status=case(
+                    (attempts >= OUTBOX_MAX_ATTEMPTS, OutboxState.FAILED.value),
+                    else_=OutboxState.PENDING.value,
+                ),
+                next_attempt_at=now,
+            )
+            .execution_options(synchronize_session=False)
+        )
+
+    async def _deliver(self, batch: list[tuple[int, str, int]]):
+        try:
+            todo_list = merge_todo_lists([json.loads(row[1]) for row in batch])
+            try:
+                link = await dispatcher.run(todo_list)
+            except asyncio.TimeoutError:
+                await self._failed(
+                    batch, f"Calendar call took longer than {dispatcher.timeout}s"
+                )
+            except Exception as error:
+                await self._failed(batch, str(error))
+            else:
+                async with self.session_factory() as db:
+                    await db.execute(
+                        update(Outbox)
+                        .where(Outbox.rowid.in_([row[0] for row in batch]))
+                        .values(
+                            status=OutboxState.DONE.value, link=link, last_error=None
+                        )
+                    )
+                    await db.commit()
+        except Exception as error:
+            # The rows stay in flight and are retried once their lease runs out
+            print(f"Outbox delivery failed: {error}")
+        finally:
+            self._slots.release()
+
+    async def _failed(self, batch: list[tuple[int, str, int]], error: str):
+        now = time.time()
+        rows = []
+        for rowid, _, attempts in batch:
+            attempts += 1
+            rows.append(
+                {
+                    "rowid": rowid,
+                    "attempts": attempts,
+                    "last_error": error,
+                    "status": (
+                        OutboxState.FAILED.value
+                        if attempts >= OUTBOX_MAX_ATTEMPTS
+                        else OutboxState.PENDING.value
+                    ),
+                    "next_attempt_at": now + backoff(attempts),
+                }
+            )
+        async with self.session_factory() as db:
+            await db.execute(update(Outbox), rows)
+            await db.commit()
+
+
+drainer = OutboxDrainer(DB_Session)
@@ -0,0 +1,95 @@
+# bcrypt runs in a pool of worker processes, so logins neither block the event loop nor
+# queue behind the GIL. This module is imported by the workers too, keep it light.
+
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+
+from dotenv import load_dotenv
+import os
+
+load_dotenv(dotenv_path="../.env")
+# bcrypt cost factor, stored hashes with a lower cost are rehashed on the next login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# Worker processes hashing passwords, defaults to one per CPU
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", str(os.cpu_count() or 1)))
+# Hashing jobs allowed to wait for a worker, further logins get a 503
+PASSWORD_QUEUE_MAX = int(os.getenv("PASSWORD_QUEUE_MAX", str(PASSWORD_WORKERS * 4)))
+
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+)
+
+
+# Run inside the workers
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify_and_update(password: str, hashed: str) -> tuple[bool, Optional[str]]:
+    return pwd_context.verify_and_update(password, hashed)
+
+
+def _dummy_verify() -> bool:
+    return pwd_context.dummy_verify()
+
+
+class PasswordPool:
+    def __init__(self, workers: int, queue_max: int):
+        self.workers = workers
+        self.queue_max = queue_max
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._pending = 0
+
+    def start(self):
+        if self._executor is None:
+            # spawn, forking a process that runs an event loop and threads is unsafe
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def hash(self, password: str) -> str:
+        return await self._run(_hash, password)
+
+    # Returns whether the password matches, and a new hash to store when the stored
+    # one is outdated (e.g. BCRYPT_ROUNDS was raised)
+    async def verify_and_update(
+        self, password: str, hashed: str
+    ) -> tuple[bool, Optional[str]]:
+        return await self._run(_verify_and_update, password, hashed)
+
+    # Takes as long as a real check, so unknown usernames cannot be told apart by timing
+    async def dummy_verify(self):
+        await self._run(_dummy_verify)
+
+    async def _run(self, function, *args):
+        if self._pending >= self.workers + self.queue_max:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many logins in progress, try again shortly",
+                headers={"Retry-After": "1"},
+            )
+        self.start()
+        self._pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, function, *args
+            )
+        finally:
+            self._pending -= 1
+
+
+pool = PasswordPool(PASSWORD_WORKERS, PASSWORD_QUEUE_MAX)
@@ -0,0 +1,121 @@
+# Long-lived refresh tokens, exchanged for a new access token (and a new refresh token)
+# without going through the password again. Only their hashes are stored.
+
+import hashlib
+import secrets
+import time
+from typing import Optional
+
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db_models.user_models import RefreshToken
+
+from dotenv import load_dotenv
+import os
+
+load_dotenv(dotenv_path="../.env")
+# Days a refresh token is valid, each refresh starts the period again
+REFRESH_TOKEN_DAYS = float(os.getenv("REFRESH_TOKEN_DAYS", "14"))
+# Seconds a replaced refresh token still gets the token that replaced it, so two tabs
+# or a retried request refreshing at once don't count as the token being copied
+REFRESH_TOKEN_GRACE = float(os.getenv("REFRESH_TOKEN_GRACE", "30"))
+
+COOKIE = "refresh_token"
+# The cookie only goes to the /auth/token/ endpoints
+COOKIE_PATH = "/auth/token/"
+
+
+def token_hash(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+# The token that replaced one is kept with it, XORed with a key only the holder of the
+# replaced token can work out, so the table still doesn't give out usable tokens
+def seal(token: str, successor: str) -> str:
+    key = hashlib.sha512(b"successor:" + token.encode()).digest()
+    return bytes(a ^ b for a, b in zip(successor.encode(), key)).hex()
+
+
+def unseal(token: str, sealed: str) -> str:
+    key = hashlib.sha512(b"successor:" + token.encode()).digest()
+    return bytes(a ^ b for a, b in zip(bytes.fromhex(sealed), key)).decode()
+
+
+# Adds a refresh token for the user, a new family unless it replaces one. Commits.
+async def issue(
+    users: AsyncSession,
+    username: str,
+    family: Optional[str] = None,
+    token: Optional[str] = None,
+) -> str:
+    now = time.time()
+    token = token or secrets.token_urlsafe(32)
+    # Expired tokens are dropped as new ones come in
+    await users.execute(delete(RefreshToken).where(RefreshToken.expires_at <= now))
+    await users.execute(
+        insert(RefreshToken).values(
+            token=token_hash(token),
+            username=username,
+            family=family or secrets.token_hex(16),
+            used=False,
+            expires_at=now + REFRESH_TOKEN_DAYS * 86400,
+        )
+    )
+    await users.commit()
+    return token
+
+
+# Uses up the refresh token and returns its user with the token replacing it, or None
+# when it is unknown or expired. A token that was already used means it was copied, so
+# the whole family is revoked and both holders have to log in again, unless it was
+# replaced less than REFRESH_TOKEN_GRACE seconds ago. Then it gets the same successor.
+async def rotate(users: AsyncSession, token: str) -> Optional[tuple[str, str]]:
+    key = token_hash(token)
+    now = time.time()
+    successor = secrets.token_urlsafe(32)
+    found = (
+        await users.execute(
+            update(RefreshToken)
+            .where(
+                RefreshToken.token == key,
+                RefreshToken.used.is_(False),
+                RefreshToken.expires_at > now,
+            )
+            .values(used=True, used_at=now, successor=seal(token, successor))
+            .returning(RefreshToken.username, RefreshToken.family)
+            .execution_options(synchronize_session=False)
+        )
+    ).first()
+    if found is not None:
+        await issue(users, found.username, found.family, successor)
+        return found.username, successor
+    reused = (
+        await users.execute(
+            select(RefreshToken).where(
+                RefreshToken.token == key, RefreshToken.used.is_(True)
+            )
+        )
+    ).scalar()
+    if reused is None:
+        await users.commit()
+        return None
+    if reused.used_at is not None and reused.used_at > now - REFRESH_TOKEN_GRACE:
+        return reused.username, unseal(token, reused.successor)
+    print(f"Refresh token of {reused.username} reused, revoking its session")
+    await users.execute(
+        delete(RefreshToken).where(RefreshToken.family == reused.family)
+    )
+    await users.commit()
+    return None
+
+
+# Logs out the session the token belongs to. Commits.
+async def revoke(users: AsyncSession, token: str):
+    family = (
+        select(RefreshToken.family)
+        .where(RefreshToken.token == token_hash(token))
+        .scalar_subquery()
+    )
+    await users.execute(delete(RefreshToken).where(RefreshToken.family == family))
+    await users.commit()
@@ -0,0 +1,196 @@
+import asyncio
+import time
+
+from sqlalchemy import case, delete, select
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker
+
+from databaseinit import DB_engine, DB_Session
+from db_models.db_models import Event, EventCount, EventRollup, Outbox
+from outbox import OutboxState
+from upserts import upsert
+import versions
+
+from dotenv import load_dotenv
+import os
+
+load_dotenv(dotenv_path="../.env")
+# Events older than this many days are rolled up per hour and deleted, 0 (the default)
+# keeps them all. Turning it on deletes the older history on its first run.
+EVENT_RETENTION_DAYS = float(os.getenv("EVENT_RETENTION_DAYS", "0"))
+# Seconds between retention runs
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "3600"))
+# Rows deleted per transaction, and the pause between transactions that lets writers in
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "1000"))
+RETENTION_BATCH_PAUSE = float(os.getenv("RETENTION_BATCH_PAUSE", "0.05"))
+
+HOUR = 3600
+
+
+def hourly_rollups(raw_timestamps: list[float]) -> list[dict]:
+    hours: dict[float, dict] = {}
+    for raw_timestamp in raw_timestamps:
+        hour = raw_timestamp // HOUR * HOUR
+        rollup = hours.setdefault(
+            hour,
+            {
+                "hour": hour,
+                "count": 0,
+                "first_raw_timestamp": raw_timestamp,
+                "last_raw_timestamp": raw_timestamp,
+            },
+        )
+        rollup["count"] += 1
+        rollup["first_raw_timestamp"] = min(
+            rollup["first_raw_timestamp"], raw_timestamp
+        )
+        rollup["last_raw_timestamp"] = max(rollup["last_raw_timestamp"], raw_timestamp)
+    return list(hours.values())
+
+
+# Rolls old Event rows into EventRollup and deletes them, along with delivered outbox
+# rows and minute and hour event counters, RETENTION_BATCH_SIZE rows per short
+# transaction so /notify/ is never locked out for long. On SQLite the freed pages are
+# handed back to the file system afterwards.
+class RetentionJob:
+    def __init__(self, engine: AsyncEngine, session_factory: async_sessionmaker):
+        self.engine = engine
+        self.session_factory = session_factory
+
+    async def run_forever(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as error:
+                # SQLAlchemy can turn a cancel that lands inside a query into a
+                # database error, which must not keep the loop alive at shutdown
+                if asyncio.current_task().cancelling():
+                    raise
+                print(f"Retention run failed: {error}")
+            await asyncio.sleep(RETENTION_INTERVAL)
+
+    async def run_once(self) -> int:
+        if EVENT_RETENTION_DAYS <= 0:
+            return 0
+        cutoff = time.time() - EVENT_RETENTION_DAYS * 24 * HOUR
+        purged = 0
+        while batch := await self._purge_events(cutoff):
+            purged += batch
+            await asyncio.sleep(RETENTION_BATCH_PAUSE)
+        while batch := await self._purge_outbox(cutoff):
+            purged += batch
+            await asyncio.sleep(RETENTION_BATCH_PAUSE)
+        while batch := await self._purge_counts(cutoff):
+            purged += batch
+            await asyncio.sleep(RETENTION_BATCH_PAUSE)
+        if purged:
+            await self._vacuum()
+            print(
+                f"Retention purged {purged} rows older than {EVENT_RETENTION_DAYS} days"
+            )
+        return purged
+
+    async def _purge_events(self, cutoff: float) -> int:
+        oldest = (
+            select(Event.rowid)
+            .where(Event.raw_timestamp < cutoff)
+            .order_by(Event.raw_timestamp)
+            .limit(RETENTION_BATCH_SIZE)
+        )
+        async with self.session_factory() as db:
+            # Deleting first claims the rows, so two workers never roll up the same event
+            results = await db.execute(
+                delete(Event)
+                .where(Event.rowid.in_(oldest.scalar_subquery()))
+                .returning(Event.raw_timestamp)
+                .execution_options(synchronize_session=False)
+            )
+            rollups = hourly_rollups(list(results.scalars().all()))
+            if rollups:
+                await versions.bump(db, Event.__tablename__)
+                await db.execute(
+                    upsert(
+                        db,
+                        EventRollup,
+                        ["hour"],
+                        lambda excluded: {
+                            "count": EventRollup.count + excluded.count,
+                            "first_raw_timestamp": case(
+                                (
+                                    excluded.first_raw_timestamp
+                                    < EventRollup.first_raw_timestamp,
+                                    excluded.first_raw_timestamp,
+                                ),
+                                else_=EventRollup.first_raw_timestamp,
+                            ),
+                            "last_raw_timestamp": case(
+                                (
+                                    excluded.last_raw_timestamp
+                                    > EventRollup.last_raw_timestamp,
+                                    excluded.last_raw_timestamp,
+                                ),
+                                else_=EventRollup.last_raw_timestamp,
+                            ),
+                        },
+                    ),
+                    rollups,
+                )
+            await db.commit()
+        return sum(rollup["count"] for rollup in rollups)
+
+    # Delivered notifications are only kept as long as their events
+    async def _purge_outbox(self, cutoff: float) -> int:
+        oldest = (
+            select(Outbox.rowid)
+            .where(Outbox.status == OutboxState.DONE.value, Outbox.created_at < cutoff)
+            .limit(RETENTION_BATCH_SIZE)
+        )
+        async with self.session_factory() as db:
+            results = await db.execute(
+                delete(Outbox)
+                .where(Outbox.rowid.in_(oldest.scalar_subquery()))
+                .execution_options(synchronize_session=False)
+            )
+            await db.commit()
+        return results.rowcount
+
+    # Minute and hour counters of /events/stats go with their events, day counters are
+    # kept as the long term history. Buckets are dropped once they end before the cutoff.
+    async def _purge_counts(self, cutoff: float) -> int:
+        oldest = (
+            select(EventCount.rowid)
+            .where(
+                EventCount.granularity.in_(["minute", "hour"]),
+                EventCount.bucket < cutoff // HOUR * HOUR,
+            )
+            .limit(RETENTION_BATCH_SIZE)
+        )
+        async with self.session_factory() as db:
+            results = await db.execute(
+                delete(EventCount)
+                .where(EventCount.rowid.in_(oldest.scalar_subquery()))
+                .execution_options(synchronize_session=False)
+            )
+            await db.commit()
+        return results.rowcount
+
+    async def _vacuum(self):
+        if self.engine.dialect.name != "sqlite":
+            # PostgreSQL's autovacuum takes care of this
+            return
+        async with self.engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            mode = (await conn.exec_driver_sql("PRAGMA auto_vacuum")).scalar()
+            if mode != 2:
+                # Files created before auto_vacuum was set get one full VACUUM to switch
+                # them to incremental mode. It rewrites the whole file and holds the
+                # write lock until it is done, so /notify/ waits on it this one time.
+                await conn.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+                await conn.exec_driver_sql("VACUUM")
+            else:
+                # Every step of incremental_vacuum frees one page and execute only takes
+                # the first one, executescript runs it to the end
+                raw = await conn.get_raw_connection()
+                await raw.driver_connection.executescript("PRAGMA incremental_vacuum")
+
+
+retention = RetentionJob(DB_engine, DB_Session)
@@ -0,0 +1,124 @@
+# Response models of the API. They are validated straight from the ORM objects (or
+# cached rows) with from_attributes, and the aliases keep the original response keys.
+
+from typing import Literal, Optional
+
+from pydantic import BaseModel, ConfigDict, EmailStr, Field
+
+
+class Row(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+
+class TodoOut(Row):
+    description: str
+    bRepeats: bool
+    rowid: int
+
+
+class EventOut(Row):
+    timestamp: str
+    raw_timestamp: float
+    description: str
+    rowid: int
+
+
+class OutboxOut(Row):
+    rowid: int
+    event_rowid: Optional[int]
+    # JSON list of the todo descriptions sent with the notification
+    todo_list: str
+    status: str
+    attempts: int
+    next_attempt_at: float
+    claimed_at: Optional[float]
+    created_at: float
+    link: Optional[str]
+    last_error: Optional[str]
+
+
+# What the API shows of a user, never the password hash or OTP secret
+class UserView(Row):
+    username: str
+    email: Optional[EmailStr] = None
+    full_name: Optional[str] = None
+    disabled: Optional[bool]
+    otp_enabled: bool
+
+
+class TodoPage(BaseModel):
+    todos: list[TodoOut] = Field(
+        serialization_alias="Here's a list of things you need to do:"
+    )
+    next_cursor: Optional[int]
+
+
+class EventPage(BaseModel):
+    events: list[EventOut] = Field(
+        serialization_alias="Here's a list of notify events:"
+    )
+    next_cursor: Optional[int]
+
+
+class WhitelistOut(BaseModel):
+    ips: list[str] = Field(serialization_alias="Here's a list of whitelisted IPs:")
+
+
+class TodoOutcome(BaseModel):
+    op: Literal["create", "update", "delete"]
+    rowid: Optional[int] = None
+    status: Literal["created", "updated", "deleted", "not_found"]
+
+
+class TodoBulkResult(BaseModel):
+    results: list[TodoOutcome]
+    rowids: list[int]
+
+
+class NotifyResult(BaseModel):
+    latest_entry: EventOut = Field(serialization_alias="Latest entry: ")
+    dispatch: int
+
+
+class NotifyBatchResult(BaseModel):
+    rowids: list[int]
+    dispatch: int
+
+
+class BucketCount(BaseModel):
+    bucket: float
+    count: int
+
+
+class DescriptionCount(BaseModel):
+    description: str
+    count: int
+
+
+class EventStats(BaseModel):
+    granularity: Literal["minute", "hour", "day"]
+    buckets: list[BucketCount]
+    descriptions: list[DescriptionCount]
+
+
+class Message(BaseModel):
+    message: str
+
+
+class Username(BaseModel):
+    username: str
+
+
+class UserCacheStats(BaseModel):
+    hits: int
+    misses: int
+    size: int
+    maxsize: int
+    ttl: float
+
+
+# One login step of /auth/login/timings/, keyed by the step name
+class StepTiming(BaseModel):
+    count: int
+    mean_ms: float
+    max_ms: float
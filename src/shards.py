@@ -0,0 +1,276 @@
+import asyncio
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import AsyncIterator, Callable, Optional
+
+from fastapi import Depends, HTTPException, Request, status
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from sqlalchemy import make_url, select
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
+
+import auth
+import db_profiles
+import migrations
+from databaseinit import DB_engine, DB_Session, Get_Users, User_Session
+from db_models.db_models import DB_Base
+from db_models.user_models import User_DB
+from outbox import OutboxDrainer, drainer
+from retention import RetentionJob
+from todo_cache import TodoCache
+from versions import VersionTracker
+
+from dotenv import load_dotenv
+import os
+
+load_dotenv(dotenv_path="../.env")
+# Gives every user their own events/todo/outbox database, e.g.
+# sqlite+aiosqlite:////var/lib/db_data/users/{user}.sqlite3. Unset keeps everyone in DB_URL.
+USER_DB_URL_TEMPLATE = os.getenv("USER_DB_URL_TEMPLATE", "")
+SHARD_DB_PROFILE = os.getenv("SHARD_DB_PROFILE", db_profiles.DB_PROFILE)
+# Max user databases kept open, the least recently used one is closed past this
+SHARD_CACHE_SIZE = int(os.getenv("SHARD_CACHE_SIZE", "64"))
+# Seconds between passes that drain and purge the databases of every user
+SHARD_SWEEP_INTERVAL = float(os.getenv("SHARD_SWEEP_INTERVAL", "3600"))
+
+
+# One events/todo/outbox database together with the jobs that work on it
+@dataclass
+class Shard:
+    name: str
+    engine: AsyncEngine
+    session_factory: async_sessionmaker
+    drainer: OutboxDrainer
+    draining: Optional[asyncio.Task] = None
+    todos: TodoCache = field(default_factory=TodoCache)
+    events: VersionTracker = field(default_factory=lambda: VersionTracker("events"))
+    # Requests, export streams and sweeps using the engine right now
+    users: int = 0
+
+    def session(self) -> AsyncSession:
+        db = self.session_factory()
+        db.info["shard"] = self
+        return db
+
+    # Keeps the shard out of eviction until the returned release is called, which may
+    # happen more than once
+    def hold(self) -> Callable[[], None]:
+        self.users += 1
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self.users -= 1
+
+        return release
+
+    # Closing now would pull the engine from under a request or strand rows in flight
+    @property
+    def busy(self) -> bool:
+        return self.users > 0 or self.drainer.busy
+
+
+# DB_URL, used when sharding is off and for requests that carry no token (devices)
+default_shard = Shard("default", DB_engine, DB_Session, drainer)
+
+
+def shard_of(db: AsyncSession) -> Shard:
+    return db.info.get("shard", default_shard)
+
+
+# Usernames are hashed so any name makes a safe file name
+def shard_key(username: str) -> str:
+    return hashlib.sha256(username.encode()).hexdigest()[:32]
+
+
+def shard_url(username: str) -> str:
+    return USER_DB_URL_TEMPLATE.format(user=shard_key(username))
+
+
+def sqlite_path(url: str) -> Optional[Path]:
+    if not db_profiles.is_sqlite(url):
+        return None
+    return Path(make_url(url).database)
+
+
+# Creates the user's database on first use and brings it to the latest schema
+async def open_database(username: str) -> tuple[AsyncEngine, async_sessionmaker]:
+    url = shard_url(username)
+    path = sqlite_path(url)
+    if path is not None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+    engine, _ = db_profiles.make_engine(url, SHARD_DB_PROFILE)
+    async with engine.begin() as conn:
+        await conn.run_sync(migrations.upgrade, migrations.DB_MIGRATIONS, DB_Base)
+    return engine, async_sessionmaker(engine, expire_on_commit=False)
+
+
+# Databases of recently active users, each with its own outbox drainer. Keeps at most
+# `size` engines (and their connection pools) open at once, more only while the least
+# recently used ones are still sending notifications.
+class ShardCache:
+    def __init__(self, size: int):
+        self.size = size
+        self._shards: OrderedDict[str, Shard] = OrderedDict()
+        self._lock = asyncio.Lock()
+        self._closing: set[asyncio.Task] = set()
+
+    # touch=False leaves the recency order alone, for the sweep. A database it has to
+    # open goes in as the least recently used one.
+    async def get(self, username: str, touch: bool = True) -> Shard:
+        shard = self._shards.get(username)
+        if shard is not None:
+            if touch:
+                self._shards.move_to_end(username)
+            return shard
+        async with self._lock:
+            if username not in self._shards:
+                self._shards[username] = await self._open(username)
+                self._shards.move_to_end(username, last=touch)
+                self._evict(keep=username)
+            elif touch:
+                self._shards.move_to_end(username)
+            return self._shards[username]
+
+    async def close_all(self):
+        shards, self._shards = list(self._shards.values()), OrderedDict()
+        await asyncio.gather(*(self._close(shard) for shard in shards), *self._closing)
+
+    # Closes the least recently used shards until the cache fits, skipping the busy
+    # ones. Those are looked at again on the next open.
+    def _evict(self, keep: str):
+        for username, shard in list(self._shards.items()):
+            if len(self._shards) <= self.size:
+                return
+            if username == keep or shard.busy:
+                continue
+            del self._shards[username]
+            # Closing waits on the drainer, don't hold up the opener
+            task = asyncio.create_task(self._close(shard))
+            self._closing.add(task)
+            task.add_done_callback(self._closing.discard)
+
+    async def _open(self, username: str) -> Shard:
+        engine, session_factory = await open_database(username)
+        shard = Shard(
+            shard_key(username), engine, session_factory, OutboxDrainer(session_factory)
+        )
+        shard.draining = asyncio.create_task(shard.drainer.run())
+        return shard
+
+    async def _close(self, shard: Shard):
+        # Rows still in flight are picked up again after OUTBOX_LEASE
+        await shard.drainer.shutdown(shard.draining)
+        await shard.engine.dispose()
+
+
+shard_cache = ShardCache(SHARD_CACHE_SIZE)
+
+
+def token_of(request: Request) -> Optional[str]:
+    authorization = request.headers.get("Authorization", "")
+    if authorization.lower().startswith("bearer "):
+        return authorization[len("bearer ") :]
+    return request.cookies.get("token")
+
+
+# Picks the database of the user behind the token cookie or bearer token. Requests
+# without a token, e.g. from devices that were not given one, use the default database.
+async def find_shard(request: Request, users: AsyncSession) -> Shard:
+    if not USER_DB_URL_TEMPLATE:
+        return default_shard
+    token = token_of(request)
+    if not token:
+        return default_shard
+    try:
+        user = await auth.get_current_user(token, users=users)
+    except HTTPException:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return await shard_cache.get(user.username)
+
+
+# The shard stays open until the request is done with it
+async def Get_Shard(
+    request: Request, users: AsyncSession = Depends(Get_Users)
+) -> AsyncIterator[Shard]:
+    shard = await find_shard(request, users)
+    release = shard.hold()
+    try:
+        yield shard
+    finally:
+        release()
+
+
+# A StreamingResponse body is sent after the request's dependencies have exited, so the
+# stream holds the shard itself until it ends or fails
+def stream_from(
+    shard: Shard, body: AsyncIterator[bytes], **kwargs
+) -> StreamingResponse:
+    release = shard.hold()
+
+    async def held() -> AsyncIterator[bytes]:
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            release()
+
+    # Also runs when the client leaves before the first chunk, held() never starts then
+    return StreamingResponse(held(), background=BackgroundTask(release), **kwargs)
+
+
+async def Get_Shard_DB(
+    shard: Shard = Depends(Get_Shard),
+) -> AsyncIterator[AsyncSession]:
+    db = shard.session()
+    try:
+        yield db
+    finally:
+        await db.close()
+
+
+# Usernames whose database already exists, so a sweep never creates empty files
+async def existing_shards() -> list[str]:
+    if not USER_DB_URL_TEMPLATE:
+        return []
+    async with User_Session() as users:
+        usernames = (await users.execute(select(User_DB.username))).scalars().all()
+    return [
+        username
+        for username in usernames
+        if (path := sqlite_path(shard_url(username))) is None or path.exists()
+    ]
+
+
+# Opening a user's database starts its drainer, which sends whatever is due there.
+# Retention runs here for user databases, the default one has its own loop. The sweep
+# doesn't count as use, so it never pushes an active user's database out of the cache.
+async def sweep():
+    for username in await existing_shards():
+        try:
+            shard = await shard_cache.get(username, touch=False)
+            release = shard.hold()
+            try:
+                await RetentionJob(shard.engine, shard.session_factory).run_once()
+            finally:
+                release()
+        except Exception as error:
+            if asyncio.current_task().cancelling():
+                raise
+            print(f"Sweep of {shard_key(username)} failed: {error}")
+
+
+async def sweep_forever():
+    if not USER_DB_URL_TEMPLATE:
+        return
+    while True:
+        await sweep()
+        await asyncio.sleep(SHARD_SWEEP_INTERVAL)
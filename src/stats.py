@@ -0,0 +1,169 @@
+# Event counters behind /events/stats. Run `python stats.py --rebuild` once after the
+# upgrade to count the events that were stored before the counters existed.
+
+import argparse
+import asyncio
+from typing import Iterable
+
+from sqlalchemy import case, delete, func, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from databaseinit import Create_Tables, DB_Session
+from db_models.db_models import Event, EventCount
+from upserts import upsert
+import shards
+
+# Bucket sizes in seconds, days start at midnight UTC
+GRANULARITIES = {"minute": 60, "hour": 3600, "day": 86400}
+
+
+def bucket_start(raw_timestamp: float, granularity: str) -> float:
+    size = GRANULARITIES[granularity]
+    return raw_timestamp // size * size
+
+
+Counts = dict[tuple[str, float, str], int]
+
+
+# Adds (raw_timestamp, description) pairs to per bucket totals, sign is -1 when the
+# events are being removed
+def count(
+    events: Iterable[tuple[float, str]], sign: int = 1, totals: Counts | None = None
+) -> Counts:
+    totals = {} if totals is None else totals
+    for raw_timestamp, description in events:
+        for granularity in GRANULARITIES:
+            key = (granularity, bucket_start(raw_timestamp, granularity), description)
+            totals[key] = totals.get(key, 0) + sign
+    return totals
+
+
+# Adds the totals to the stored counters, or with keep_larger only raises a counter to
+# its total
+async def add_counts(db: AsyncSession, totals: Counts, keep_larger: bool = False):
+    rows = [
+        {
+            "granularity": granularity,
+            "bucket": bucket,
+            "description": description,
+            "count": total,
+        }
+        for (granularity, bucket, description), total in totals.items()
+    ]
+    if rows:
+        await db.execute(
+            upsert(
+                db,
+                EventCount,
+                ["granularity", "bucket", "description"],
+                lambda excluded: {
+                    "count": (
+                        case(
+                            (excluded.count > EventCount.count, excluded.count),
+                            else_=EventCount.count,
+                        )
+                        if keep_larger
+                        else EventCount.count + excluded.count
+                    )
+                },
+            ),
+            rows,
+        )
+
+
+# Updates the counters in the caller's transaction, so they commit with the events
+async def record(db: AsyncSession, events: Iterable[tuple[float, str]], sign: int = 1):
+    await add_counts(db, count(events, sign))
+
+
+async def summary(
+    db: AsyncSession,
+    granularity: str,
+    since: float | None = None,
+    until: float | None = None,
+    description: str | None = None,
+) -> dict:
+    conditions = [EventCount.granularity == granularity]
+    if since is not None:
+        conditions.append(EventCount.bucket >= bucket_start(since, granularity))
+    if until is not None:
+        conditions.append(EventCount.bucket < until)
+    if description is not None:
+        conditions.append(EventCount.description == description)
+    total = func.sum(EventCount.count)
+    buckets = await db.execute(
+        select(EventCount.bucket, total)
+        .where(*conditions)
+        .group_by(EventCount.bucket)
+        .having(total > 0)
+        .order_by(EventCount.bucket)
+    )
+    descriptions = await db.execute(
+        select(EventCount.description, total)
+        .where(*conditions)
+        .group_by(EventCount.description)
+        .having(total > 0)
+        .order_by(total.desc())
+    )
+    return {
+        "granularity": granularity,
+        "buckets": [{"bucket": bucket, "count": count} for bucket, count in buckets],
+        "descriptions": [
+            {"description": description, "count": count}
+            for description, count in descriptions
+        ],
+    }
+
+
+# Recounts the counters from the events table. Buckets older than the oldest remaining
+# event are left alone, they still hold the counts of events removed by retention. The
+# bucket holding the oldest event may have lost events to retention too, so its counters
+# are only ever raised to the recount, never lowered.
+async def rebuild(
+    session_factory: async_sessionmaker = DB_Session, chunk_size: int = 10000
+) -> int:
+    async with session_factory() as db:
+        oldest = (await db.execute(select(func.min(Event.raw_timestamp)))).scalar()
+        if oldest is None:
+            return 0
+        for granularity in GRANULARITIES:
+            await db.execute(
+                delete(EventCount).where(
+                    EventCount.granularity == granularity,
+                    EventCount.bucket > bucket_start(oldest, granularity),
+                )
+            )
+        counted = 0
+        totals: Counts = {}
+        results = await db.stream(
+            select(Event.raw_timestamp, Event.description)
+            .order_by(Event.rowid)
+            .execution_options(yield_per=chunk_size)
+        )
+        async for events in results.partitions():
+            count(events, totals=totals)
+            counted += len(events)
+        await add_counts(db, totals, keep_larger=True)
+        await db.commit()
+    return counted
+
+
+async def main(args):
+    await Create_Tables()
+    if args.rebuild:
+        print(f"default: counted {await rebuild(chunk_size=args.chunk_size)} events")
+        # Every user database when USER_DB_URL_TEMPLATE is set
+        for username in await shards.existing_shards():
+            engine, session_factory = await shards.open_database(username)
+            counted = await rebuild(session_factory, args.chunk_size)
+            print(f"{shards.shard_key(username)}: counted {counted} events")
+            await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the /events/stats counters")
+    parser.add_argument(
+        "--rebuild", action="store_true", help="Recount the counters from the events"
+    )
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    asyncio.run(main(parser.parse_args()))
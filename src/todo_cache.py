@@ -0,0 +1,125 @@
+import asyncio
+import bisect
+import time
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db_models.db_models import Todo
+import versions
+
+from dotenv import load_dotenv
+import os
+
+load_dotenv(dotenv_path="../.env")
+# Seconds a cached todo list is trusted before its version is compared with the
+# database, which is how changes made by other workers are noticed. 0 checks every read.
+TODO_CACHE_CHECK = float(os.getenv("TODO_CACHE_CHECK", "1"))
+
+TABLE = "todo"
+
+
+# Detached copy of a Todo row, serialized the same way
+@dataclass(frozen=True)
+class TodoRow:
+    description: str
+    bRepeats: bool
+    rowid: int
+
+    @classmethod
+    def of(cls, todo: Todo) -> "TodoRow":
+        return cls(todo.description, todo.bRepeats, todo.rowid)
+
+
+# The todo table of one database, kept in memory sorted by rowid. Endpoints that change
+# todos bump the table version in their transaction and then apply the same change
+# here (write-through). When another writer got in between, the cache is dropped and
+# reloaded on the next read instead.
+class TodoCache:
+    def __init__(self):
+        self.version: Optional[int] = None
+        self._rows: list[TodoRow] = []
+        self._rowids: list[int] = []
+        self._checked_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def rows(self, db: AsyncSession) -> list[TodoRow]:
+        if (
+            self.version is None
+            or time.monotonic() - self._checked_at >= TODO_CACHE_CHECK
+        ):
+            await self._refresh(db)
+        return self._rows
+
+    async def page(
+        self, db: AsyncSession, cursor: Optional[int], limit: int
+    ) -> list[TodoRow]:
+        rows = await self.rows(db)
+        start = 0 if cursor is None else bisect.bisect_right(self._rowids, cursor)
+        return rows[start : start + limit]
+
+    def invalidate(self):
+        self.version = None
+
+    # Bumps the table version, commits the caller's transaction and applies the same
+    # change to the cache. Nothing is bumped when no todo changed.
+    async def commit(
+        self,
+        db: AsyncSession,
+        upserted: Iterable[Todo] = (),
+        removed: Iterable[int] = (),
+    ):
+        upserted, removed = [TodoRow.of(todo) for todo in upserted], list(removed)
+        if not upserted and not removed:
+            await db.commit()
+            return
+        version = await versions.bump(db, TABLE)
+        await db.commit()
+        self.apply(version, upserted, removed)
+
+    # Write-through with the version bump() returned, only when it follows the cached one
+    def apply(
+        self,
+        version: int,
+        upserted: Iterable[TodoRow] = (),
+        removed: Iterable[int] = (),
+    ):
+        if not self._follows(version):
+            return
+        changed = {row.rowid: row for row in upserted}
+        dropped = set(removed) | changed.keys()
+        rows = [row for row in self._rows if row.rowid not in dropped]
+        rows.extend(changed.values())
+        rows.sort(key=lambda row: row.rowid)
+        self._replace(version, rows)
+
+    def _follows(self, version: int) -> bool:
+        if self.version is not None and version == self.version + 1:
+            return True
+        self.invalidate()
+        return False
+
+    def _replace(self, version: int, rows: list[TodoRow]):
+        self._rows = rows
+        self._rowids = [row.rowid for row in rows]
+        self.version = version
+
+    async def _refresh(self, db: AsyncSession):
+        async with self._lock:
+            if (
+                self.version is not None
+                and time.monotonic() - self._checked_at < TODO_CACHE_CHECK
+            ):
+                return
+            checked_at = time.monotonic()
+            version = await versions.current(db, TABLE)
+            if version != self.version:
+                results = await db.execute(select(Todo).order_by(Todo.rowid))
+                rows = [TodoRow.of(todo) for todo in results.scalars().all()]
+                # A write-through that landed meanwhile is newer than what was read
+                if self.version is None or version > self.version:
+                    self._replace(version, rows)
+            self._checked_at = checked_at
+
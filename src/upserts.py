@@ -0,0 +1,27 @@
+from typing import Any, Callable
+
+from sqlalchemy import Insert
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import DeclarativeBase
+
+# Both dialects spell INSERT ... ON CONFLICT DO UPDATE the same way
+INSERTS = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}
+
+
+def upsert(
+    db: AsyncSession,
+    model: type[DeclarativeBase],
+    index_elements: list[str],
+    set_: Callable[[Any], dict],
+) -> Insert:
+    """INSERT for the session's backend that updates the existing row when the
+    index_elements collide. set_ gets the excluded (proposed) row and returns the
+    columns to update. Execute it with a list of rows to upsert them all at once."""
+    dialect = db.bind.dialect.name
+    if dialect not in INSERTS:
+        raise NotImplementedError(f"No upsert for {dialect}")
+    statement = INSERTS[dialect](model)
+    return statement.on_conflict_do_update(
+        index_elements=index_elements, set_=set_(statement.excluded)
+    )
@@ -0,0 +1,60 @@
+import time
+from typing import Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db_models.db_models import TableVersion
+from upserts import upsert
+
+from dotenv import load_dotenv
+import os
+
+load_dotenv(dotenv_path="../.env")
+# Seconds a known table version is trusted before it is read again, changes made by
+# other workers show up after at most this long
+TABLE_VERSION_CHECK = float(os.getenv("TABLE_VERSION_CHECK", "1"))
+
+
+# Call in the transaction that changes the table, returns the table's new version
+async def bump(db: AsyncSession, name: str) -> int:
+    statement = (
+        upsert(
+            db,
+            TableVersion,
+            ["name"],
+            lambda excluded: {"version": TableVersion.version + 1},
+        )
+        .values(name=name, version=1)
+        .returning(TableVersion.version)
+    )
+    return (await db.execute(statement)).scalar_one()
+
+
+async def current(db: AsyncSession, name: str) -> int:
+    results = await db.execute(
+        select(TableVersion.version).where(TableVersion.name == name)
+    )
+    return results.scalar() or 0
+
+
+# Last known version of a table, checked against the database at most every
+# TABLE_VERSION_CHECK seconds. Lets a request find out that nothing changed without
+# a query, e.g. to answer If-None-Match.
+class VersionTracker:
+    def __init__(self, name: str):
+        self.name = name
+        self.version: Optional[int] = None
+        self._checked_at = 0.0
+
+    async def get(self, db: AsyncSession) -> int:
+        now = time.monotonic()
+        if self.version is None or now - self._checked_at >= TABLE_VERSION_CHECK:
+            self.note(await current(db, self.name))
+            self._checked_at = now
+        return self.version
+
+    # Called after committing a bump(), so this process sees its own writes at once
+    def note(self, version: int):
+        if self.version is None or version > self.version:
+            self.version = version
@@ -0,0 +1,102 @@
+import asyncio
+import ipaddress
+from typing import Iterable
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from databaseinit import Whitelist_Session
+from db_models.whitelist_models import Whitelist_DB
+
+from dotenv import load_dotenv
+import os
+
+load_dotenv(dotenv_path="../.env")
+# Reject requests from addresses that are not whitelisted
+IP_WHITELIST_ENABLED = os.getenv("IP_WHITELIST_ENABLED", "false").lower() == "true"
+# Seconds between reloads from the database, picks up changes made by other workers
+IP_WHITELIST_REFRESH = float(os.getenv("IP_WHITELIST_REFRESH", "60"))
+
+Network = ipaddress.IPv4Network | ipaddress.IPv6Network
+
+
+def parse_entry(entry: str) -> Network:
+    """Accepts a single address or a CIDR block, raises ValueError otherwise."""
+    return ipaddress.ip_network(entry.strip(), strict=False)
+
+
+# In-memory index of the whitelist. Networks are bucketed by IP version and prefix
+# length, so a lookup costs one set probe per distinct prefix length instead of a scan
+# over every entry.
+class IPWhitelist:
+    def __init__(self, session_factory: async_sessionmaker):
+        self.session_factory = session_factory
+        self._prefixes: dict[tuple[int, int], set[int]] = {}
+        self._entries: set[Network] = set()
+
+    def __contains__(self, host: str) -> bool:
+        try:
+            address = ipaddress.ip_address(host)
+        except ValueError:
+            return False
+        bits = address.max_prefixlen
+        for (version, prefixlen), networks in self._prefixes.items():
+            if (
+                version == address.version
+                and int(address) >> (bits - prefixlen) in networks
+            ):
+                return True
+        return False
+
+    def entries(self) -> list[str]:
+        return sorted(str(network) for network in self._entries)
+
+    def add(self, network: Network):
+        self._entries.add(network)
+        key = (network.version, network.prefixlen)
+        self._prefixes.setdefault(key, set()).add(self._network_key(network))
+
+    def remove(self, network: Network):
+        self._entries.discard(network)
+        key = (network.version, network.prefixlen)
+        networks = self._prefixes.get(key, set())
+        networks.discard(self._network_key(network))
+        if not networks:
+            self._prefixes.pop(key, None)
+
+    def replace(self, networks: Iterable[Network]):
+        index = IPWhitelist(self.session_factory)
+        for network in networks:
+            index.add(network)
+        self._prefixes, self._entries = index._prefixes, index._entries
+
+    async def load(self):
+        async with self.session_factory() as whitelist:
+            results = await whitelist.execute(select(Whitelist_DB.ip))
+            entries = results.scalars().all()
+        networks = []
+        for entry in entries:
+            try:
+                networks.append(parse_entry(entry))
+            except ValueError:
+                print(f"Skipping invalid whitelist entry {entry!r}")
+        self.replace(networks)
+
+    async def refresh_forever(self):
+        while True:
+            await asyncio.sleep(IP_WHITELIST_REFRESH)
+            try:
+                await self.load()
+            except Exception as error:
+                if asyncio.current_task().cancelling():
+                    raise
+                print(f"Whitelist reload failed: {error}")
+
+    @staticmethod
+    def _network_key(network: Network) -> int:
+        return int(network.network_address) >> (
+            network.max_prefixlen - network.prefixlen
+        )
+
+
+ip_whitelist = IPWhitelist(Whitelist_Session)
@@ -0,0 +1,71 @@
+import asyncio
+import os
+import sys
+import tempfile
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+
+# The modules under src/ import each other by name and create their engines on import,
+# so the databases have to point somewhere harmless before the first test imports them
+DATA_DIR = tempfile.mkdtemp(prefix="feint-tests-")
+for name, file in [
+    ("DB_URL", "database"),
+    ("USERS_DB_URL", "users"),
+    ("WHITELIST_DB_URL", "whitelist"),
+]:
+    os.environ[name] = f"sqlite+aiosqlite:///{DATA_DIR}/{file}.sqlite3"
+os.environ.setdefault("SUPER_SECRET_KEY", "tests")
+os.environ.setdefault("CALENDAR_SINK", "recorder")
+# Cheap hashes for the login tests
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+os.environ.setdefault("PASSWORD_WORKERS", "2")
+# Database the db_engine tests run on, e.g. postgresql+asyncpg://postgres@/feint_tests.
+# Its tables are dropped before every test. Unset gives each test a new SQLite file.
+TEST_DB_URL = os.getenv("TEST_DB_URL", "")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import NullPool
+
+import db_profiles
+import migrations
+from db_models.db_models import DB_Base
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "sqlite_only: tests SQLite behaviour, skipped under TEST_DB_URL"
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    if not TEST_DB_URL or db_profiles.is_sqlite(TEST_DB_URL):
+        return
+    skip = pytest.mark.skip(reason=f"SQLite only, TEST_DB_URL is {TEST_DB_URL}")
+    for item in items:
+        if "sqlite_only" in item.keywords:
+            item.add_marker(skip)
+
+
+async def migrate(engine: AsyncEngine):
+    async with engine.begin() as conn:
+        await conn.run_sync(DB_Base.metadata.drop_all)
+        await conn.run_sync(migrations.drop_version)
+        await conn.run_sync(migrations.upgrade, migrations.DB_MIGRATIONS, DB_Base)
+
+
+# An events/todo/outbox database at the latest schema version. Connections are not
+# pooled, so each asyncio.run() in a test opens its own on its own event loop.
+@pytest.fixture
+def db_engine(tmp_path) -> Iterator[AsyncEngine]:
+    url = TEST_DB_URL or f"sqlite+aiosqlite:///{tmp_path}/database.sqlite3"
+    engine = create_async_engine(url, poolclass=NullPool)
+    if db_profiles.is_sqlite(url):
+        profile = db_profiles.get_profile("balanced")
+        db_profiles.apply_profile(engine.sync_engine, profile)
+    asyncio.run(migrate(engine))
+    yield engine
+    asyncio.run(engine.dispose())
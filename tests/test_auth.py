@@ -0,0 +1,106 @@
+import itertools
+from typing import Iterator
+
+import pytest
+from fastapi.testclient import TestClient
+
+import api
+import refresh_tokens
+
+usernames = (f"user{n}" for n in itertools.count())
+
+
+@pytest.fixture(scope="module")
+def client() -> Iterator[TestClient]:
+    # The cookies are marked secure, so they only come back over https
+    with TestClient(api.app, base_url="https://testserver") as client:
+        yield client
+
+
+# Registers a user without OTP and goes through the password and token steps
+def log_in(client: TestClient) -> str:
+    client.cookies.clear()
+    username = next(usernames)
+    assert client.post(
+        "/auth/register/", params={"username": username, "password": "pw"}
+    ).json()
+    login = client.get("/auth/login/", params={"username": username, "password": "pw"})
+    assert login.json()["status"] == 0
+    assert client.get("/auth/login/token/").status_code == 200
+    return username
+
+
+def refresh_cookie(client: TestClient) -> str:
+    return client.cookies.get(refresh_tokens.COOKIE, path=refresh_tokens.COOKIE_PATH)
+
+
+# Refreshes with the given refresh token alone, returns the status and the new token
+def refresh(client: TestClient, token: str) -> tuple[int, str]:
+    client.cookies.clear()
+    client.cookies.set(refresh_tokens.COOKIE, token, path=refresh_tokens.COOKIE_PATH)
+    response = client.post("/auth/token/refresh/")
+    return response.status_code, response.cookies.get(refresh_tokens.COOKIE)
+
+
+def test_ticket_to_token(client):
+    username = log_in(client)
+    assert client.get("/whoami/").json() == {"username": username}
+    # The ticket is used up by the token step
+    assert client.get("/auth/login/token/").status_code == 401
+
+
+def test_token_before_password_step(client):
+    client.cookies.clear()
+    client.cookies.set("login_ticket", "made up")
+    assert client.get("/auth/login/token/").status_code == 401
+
+
+def test_rotation(client):
+    log_in(client)
+    first = refresh_cookie(client)
+    status, second = refresh(client, first)
+    assert status == 200
+    assert second != first
+    status, third = refresh(client, second)
+    assert status == 200
+    assert third not in (first, second)
+
+
+# Two tabs refreshing with the same token both end up with the same new one
+def test_reuse_within_grace(client):
+    log_in(client)
+    first = refresh_cookie(client)
+    assert refresh(client, first) == refresh(client, first)
+
+
+# Once the grace period is over, a replaced token is taken as copied and ends the
+# session for its current holder too
+def test_reuse_revokes_family(client, monkeypatch):
+    monkeypatch.setattr(refresh_tokens, "REFRESH_TOKEN_GRACE", 0)
+    log_in(client)
+    first = refresh_cookie(client)
+    status, second = refresh(client, first)
+    assert status == 200
+    assert refresh(client, first) == (401, None)
+    assert refresh(client, second) == (401, None)
+
+
+def test_revoke(client):
+    log_in(client)
+    token = refresh_cookie(client)
+    assert client.post("/auth/token/revoke/").status_code == 200
+    assert refresh(client, token) == (401, None)
+
+
+# The access token outlives a logout, but it can't be turned into a new session
+def test_stale_token_replay(client):
+    log_in(client)
+    token = client.cookies.get("token")
+    assert client.post("/auth/token/revoke/").status_code == 200
+    client.cookies.clear()
+    client.cookies.set("token", token)
+    replay = client.get("/auth/login/otp/", params={"enabling_otp": True})
+    assert replay.status_code == 200
+    assert "login_ticket" not in replay.cookies
+    assert client.get("/auth/login/token/").status_code == 401
+    assert refresh_cookie(client) is None
@@ -0,0 +1,39 @@
+import asyncio
+import json
+
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker
+
+import shards
+import versions
+from api import DeviceMessage, record_notifications
+from db_models.db_models import Outbox, Todo
+from todo_cache import TodoCache
+
+
+async def notify_with_stale_cache(engine: AsyncEngine) -> tuple[list[str], list[str]]:
+    session_factory = async_sessionmaker(engine, expire_on_commit=False)
+    todos = shards.default_shard.todos
+    async with session_factory() as db:
+        await db.execute(insert(Todo).values(description="Sent", bRepeats=False))
+        await todos.commit(db)
+        await todos.rows(db)
+    # Another worker adds a todo while this worker's cache is still trusted
+    async with session_factory() as db:
+        await db.execute(insert(Todo).values(description="Added", bRepeats=False))
+        await versions.bump(db, Todo.__tablename__)
+        await db.commit()
+    async with session_factory() as db:
+        await record_notifications(db, [DeviceMessage(message="Door opened")])
+    async with session_factory() as db:
+        left = (await db.execute(select(Todo.description))).scalars().all()
+        sent = (await db.execute(select(Outbox.todo_list))).scalar_one()
+    return json.loads(sent), list(left)
+
+
+# A todo the notification did not list must survive the purge
+def test_purge_spares_todos_not_sent(db_engine, monkeypatch):
+    monkeypatch.setattr(shards.default_shard, "todos", TodoCache())
+    sent, left = asyncio.run(notify_with_stale_cache(db_engine))
+    assert sent == ["Sent"]
+    assert left == ["Added"]
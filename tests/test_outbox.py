@@ -0,0 +1,113 @@
+import asyncio
+import time
+
+import pytest
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker
+
+import NotifyCalendar
+import outbox
+from db_models.db_models import Outbox
+from dispatcher import Dispatcher
+from outbox import OutboxDrainer, OutboxState
+
+
+@pytest.fixture(autouse=True)
+def fast_drainer(monkeypatch):
+    monkeypatch.setattr(outbox, "dispatcher", Dispatcher(2, 5))
+    monkeypatch.setattr(outbox, "OUTBOX_MAX_ATTEMPTS", 3)
+    monkeypatch.setattr(outbox, "OUTBOX_BACKOFF", 0)
+    monkeypatch.setattr(outbox, "OUTBOX_POLL_INTERVAL", 0.01)
+    monkeypatch.setattr(outbox, "NOTIFY_COALESCE_WINDOW", 0)
+
+
+def recorded() -> int:
+    return len(NotifyCalendar.client.events)
+
+
+# Runs a drainer until the row is done or failed, returns the row
+async def drain(engine: AsyncEngine, **row) -> Outbox:
+    session_factory = async_sessionmaker(engine, expire_on_commit=False)
+    now = time.time()
+    values = {
+        "todo_list": '["Water plants"]',
+        "status": OutboxState.PENDING.value,
+        "attempts": 0,
+        "next_attempt_at": now,
+        "created_at": now,
+    }
+    async with session_factory() as db:
+        rowid = (
+            await db.execute(
+                insert(Outbox).values(**{**values, **row}).returning(Outbox.rowid)
+            )
+        ).scalar_one()
+        await db.commit()
+    drainer = OutboxDrainer(session_factory)
+    task = asyncio.create_task(drainer.run())
+    finished = {OutboxState.DONE.value, OutboxState.FAILED.value}
+    try:
+        async with asyncio.timeout(10):
+            while True:
+                async with session_factory() as db:
+                    found = await db.get(Outbox, rowid)
+                if found.status in finished:
+                    break
+                await asyncio.sleep(0.01)
+            # Stopped between claims, so no query is cut off
+            while drainer.busy:
+                await asyncio.sleep(0.001)
+    finally:
+        await drainer.shutdown(task)
+    return found
+
+
+def test_delivery(db_engine):
+    before = recorded()
+    row = asyncio.run(drain(db_engine))
+    assert row.status == OutboxState.DONE.value
+    assert row.attempts == 0
+    assert row.link.startswith("recorder://")
+    assert recorded() == before + 1
+
+
+# Every failed call is an attempt, the last one marks the row failed for good
+def test_failing_delivery(db_engine, monkeypatch):
+    def insert_event(event: dict) -> dict:
+        raise RuntimeError("Calendar is down")
+
+    monkeypatch.setattr(NotifyCalendar.client, "insert_event", insert_event)
+    row = asyncio.run(drain(db_engine))
+    assert row.status == OutboxState.FAILED.value
+    assert row.attempts == 3
+    assert row.last_error == "Calendar is down"
+
+
+# The worker holding the row died, the reclaim counts that as an attempt and retries
+def test_expired_lease(db_engine):
+    before = recorded()
+    claimed_at = time.time() - outbox.OUTBOX_LEASE - 1
+    row = asyncio.run(
+        drain(db_engine, status=OutboxState.IN_FLIGHT.value, claimed_at=claimed_at)
+    )
+    assert row.status == OutboxState.DONE.value
+    assert row.attempts == 1
+    assert recorded() == before + 1
+
+
+# A row whose worker keeps dying is given up on like one whose calls keep failing
+def test_expired_lease_on_last_attempt(db_engine):
+    before = recorded()
+    claimed_at = time.time() - outbox.OUTBOX_LEASE - 1
+    row = asyncio.run(
+        drain(
+            db_engine,
+            status=OutboxState.IN_FLIGHT.value,
+            claimed_at=claimed_at,
+            attempts=2,
+        )
+    )
+    assert row.status == OutboxState.FAILED.value
+    assert row.attempts == 3
+    assert row.last_error == "Lease expired before the Calendar call finished"
+    assert recorded() == before
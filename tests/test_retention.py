@@ -0,0 +1,106 @@
+import asyncio
+import os
+import time
+
+import pytest
+from sqlalchemy import func, insert, select
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker
+
+from db_models.db_models import Event, EventCount
+import retention
+from retention import RetentionJob
+import stats
+
+
+# Retention is off by default, the tests keep 30 days
+@pytest.fixture(autouse=True)
+def retention_days(monkeypatch):
+    monkeypatch.setattr(retention, "EVENT_RETENTION_DAYS", 30)
+
+
+# Moves WAL pages into the file, so its size is what the database takes up
+async def checkpoint(engine: AsyncEngine) -> int:
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+        return (await conn.exec_driver_sql("PRAGMA freelist_count")).scalar()
+
+
+async def purge_old_events(engine: AsyncEngine) -> tuple[int, int, int, int]:
+    path = engine.url.database
+    old = time.time() - 365 * 24 * 3600
+    async with engine.begin() as conn:
+        await conn.execute(
+            insert(Event),
+            [
+                {
+                    "timestamp": "old",
+                    "raw_timestamp": old + i,
+                    "description": "x" * 1000,
+                }
+                for i in range(5000)
+            ],
+        )
+    await checkpoint(engine)
+    size = os.path.getsize(path)
+    await RetentionJob(engine, async_sessionmaker(engine)).run_once()
+    free = await checkpoint(engine)
+    async with engine.connect() as conn:
+        left = (await conn.execute(select(func.count()).select_from(Event))).scalar()
+    return size, free, left, os.path.getsize(path)
+
+
+@pytest.mark.sqlite_only
+def test_retention_shrinks_file(db_engine):
+    size, free, left, new_size = asyncio.run(purge_old_events(db_engine))
+    assert left == 0
+    assert free == 0
+    assert new_size < size // 10
+
+
+async def auto_vacuum(engine: AsyncEngine) -> int:
+    async with engine.connect() as conn:
+        return (await conn.exec_driver_sql("PRAGMA auto_vacuum")).scalar()
+
+
+# A new file never needs the full VACUUM that switches it to incremental mode
+@pytest.mark.sqlite_only
+def test_new_file_is_incremental(db_engine):
+    assert asyncio.run(auto_vacuum(db_engine)) == 2
+
+
+async def counters_after_retention(engine: AsyncEngine) -> dict[str, int]:
+    session_factory = async_sessionmaker(engine)
+    now = time.time()
+    events = [(now - 365 * 24 * 3600, "old"), (now, "new")]
+    async with session_factory() as db:
+        await stats.record(db, events)
+        await db.commit()
+    await RetentionJob(engine, session_factory).run_once()
+    async with session_factory() as db:
+        results = await db.execute(
+            select(EventCount.granularity, func.sum(EventCount.count)).group_by(
+                EventCount.granularity
+            )
+        )
+        return dict(results.all())
+
+
+# Day counters keep the history, minute and hour counters go with the events
+def test_retention_prunes_fine_counters(db_engine):
+    counters = asyncio.run(counters_after_retention(db_engine))
+    assert counters == {"minute": 1, "hour": 1, "day": 2}
+
+
+async def purge_oldest_event(engine: AsyncEngine) -> int:
+    async with engine.begin() as conn:
+        await conn.execute(
+            insert(Event).values(timestamp="", raw_timestamp=0, description="old")
+        )
+    return await RetentionJob(engine, async_sessionmaker(engine)).run_once()
+
+
+# 0, the default, keeps even an event from 1970
+def test_zero_days_keeps_everything(db_engine, monkeypatch):
+    monkeypatch.setattr(retention, "EVENT_RETENTION_DAYS", 0)
+    assert asyncio.run(purge_oldest_event(db_engine)) == 0
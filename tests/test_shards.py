@@ -0,0 +1,62 @@
+import asyncio
+from types import SimpleNamespace
+
+import shards
+
+
+class FakeCache(shards.ShardCache):
+    def __init__(self, size: int):
+        super().__init__(size)
+        self.closed: list[str] = []
+
+    async def _open(self, username: str) -> shards.Shard:
+        return shards.Shard(username, None, None, SimpleNamespace(busy=False))
+
+    async def _close(self, shard):
+        self.closed.append(shard.name)
+
+
+async def open_all(cache: FakeCache, usernames: list[str]):
+    for username in usernames:
+        await cache.get(username)
+
+
+def test_sweep_keeps_recency():
+    async def run():
+        cache = FakeCache(2)
+        await open_all(cache, ["a", "b"])
+        await cache.get("a", touch=False)
+        await cache.get("c", touch=False)
+        await asyncio.gather(*cache._closing)
+        return list(cache._shards), cache.closed
+
+    # c only took the place of the least recently used a, b was used last
+    assert asyncio.run(run()) == (["c", "b"], ["a"])
+
+
+def test_busy_shard_stays_open():
+    async def run():
+        cache = FakeCache(2)
+        await open_all(cache, ["a", "b"])
+        cache._shards["a"].drainer.busy = True
+        await cache.get("c")
+        await asyncio.gather(*cache._closing)
+        return list(cache._shards), cache.closed
+
+    assert asyncio.run(run()) == (["a", "c"], ["b"])
+
+
+# A request still holding an evicted engine, e.g. a running export, keeps it open
+def test_held_shard_stays_open():
+    async def run():
+        cache = FakeCache(2)
+        await open_all(cache, ["a", "b"])
+        release = cache._shards["a"].hold()
+        await cache.get("c")
+        release()
+        release()
+        await cache.get("d")
+        await asyncio.gather(*cache._closing)
+        return list(cache._shards), cache.closed
+
+    assert asyncio.run(run()) == (["c", "d"], ["b", "a"])
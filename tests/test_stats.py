@@ -0,0 +1,41 @@
+import asyncio
+
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker
+
+from db_models.db_models import Event, EventCount
+import stats
+
+# Start of an hour bucket, its last event is the only one retention left
+HOUR = 480000 * 3600
+LAST = HOUR + 3000
+
+
+async def hour_count_after_rebuild(engine: AsyncEngine, counted: list[float]) -> int:
+    session_factory = async_sessionmaker(engine)
+    async with session_factory() as db:
+        await db.execute(
+            insert(Event).values(timestamp="", raw_timestamp=LAST, description="a")
+        )
+        await stats.record(db, [(raw_timestamp, "a") for raw_timestamp in counted])
+        await db.commit()
+    await stats.rebuild(session_factory)
+    async with session_factory() as db:
+        return (
+            await db.execute(
+                select(EventCount.count).where(
+                    EventCount.granularity == "hour", EventCount.bucket == HOUR
+                )
+            )
+        ).scalar()
+
+
+# The counters still hold the two events retention removed from the hour
+def test_rebuild_keeps_partly_purged_bucket(db_engine):
+    counted = [HOUR + 60, HOUR + 120, LAST]
+    assert asyncio.run(hour_count_after_rebuild(db_engine, counted)) == 3
+
+
+# Events stored before the counters existed are counted
+def test_rebuild_counts_uncounted_events(db_engine):
+    assert asyncio.run(hour_count_after_rebuild(db_engine, [])) == 1
@@ -0,0 +1,41 @@
+import asyncio
+
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker
+
+from api import TodoOperation, apply_todo_operations
+from db_models.db_models import Todo
+
+
+async def delete_and_create(
+    engine: AsyncEngine,
+) -> tuple[list[dict], list[tuple[int, str]]]:
+    async with engine.begin() as conn:
+        await conn.execute(
+            insert(Todo),
+            [
+                {"description": "Water plants", "bRepeats": True},
+                {"description": "Feed cat", "bRepeats": True},
+            ],
+        )
+    async with async_sessionmaker(engine, expire_on_commit=False)() as db:
+        outcomes = await apply_todo_operations(
+            db,
+            [
+                TodoOperation(op="delete", rowid=2),
+                TodoOperation(op="create", description="Buy milk", bRepeats=False),
+            ],
+        )
+        results = await db.execute(select(Todo.rowid, Todo.description))
+        todos = sorted(results.all())
+    return outcomes, todos
+
+
+# The new todo must not take the rowid of the highest one deleted next to it
+def test_create_does_not_reuse_deleted_rowid(db_engine):
+    outcomes, todos = asyncio.run(delete_and_create(db_engine))
+    assert outcomes == [
+        {"op": "delete", "rowid": 2, "status": "deleted"},
+        {"op": "create", "rowid": 3, "status": "created"},
+    ]
+    assert todos == [(1, "Water plants"), (3, "Buy milk")]